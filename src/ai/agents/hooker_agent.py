@@ -11,18 +11,53 @@ Hooker Agent - 简化版条件触发消息代理
 """
 
 import asyncio
+import heapq
 import os
 import json
-import uuid
 import logging
 import re
+import time
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Callable, Any
+from typing import Optional, Dict, List, Set, Callable, Any
 from dataclasses import dataclass, asdict
 from enum import Enum
 
+try:
+    import orjson
+
+    def _dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+    def _dumps_line(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    _loads = orjson.loads
+except ImportError:  # orjson 未安装时回退到标准库
+    def _dumps(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+    def _dumps_line(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    _loads = json.loads
+
+try:
+    import ahocorasick
+except ImportError:  # 未安装 pyahocorasick 时逐个关键词做子串匹配
+    ahocorasick = None
+
 logger = logging.getLogger("HookerAgent")
 
+HOOK_TTL_SECONDS = 604800  # 7天未触发视为过期
+
+# 中文相对时间: 10秒后, 5分钟后, 2小时后
+_CN_REL_TIME_RE = re.compile(r'(\d+)(秒|分钟|小时|天)后')
+_CN_UNIT = {'秒': 'seconds', '分钟': 'minutes', '小时': 'hours', '天': 'days'}
+
+# 绝对时间格式
+_ABS_FMTS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%H:%M:%S", "%H:%M")
+_TIME_ONLY_FMTS = ("%H:%M:%S", "%H:%M")
+
 
 class TriggerType(Enum):
     """触发类型"""
@@ -30,7 +65,11 @@ class TriggerType(Enum):
     KEYWORD = "keyword"  # 关键词触发
 
 
-@dataclass
+_TT_TIME: str = TriggerType.TIME.value
+_TT_KEYWORD: str = TriggerType.KEYWORD.value
+
+
+@dataclass(slots=True)
 class Hook:
     """Hook 数据结构（简化版）"""
     hook_id: str
@@ -42,6 +81,7 @@ class Hook:
     created_at: float           # 创建时间戳
     triggered: bool = False     # 是否已触发
     trigger_time: Optional[float] = None  # 实际触发时间戳
+    trigger_ts: float = 0.0     # 时间触发：目标时间戳（由 trigger_value 解析一次后缓存）
     
     def to_dict(self) -> dict:
         return asdict(self)
@@ -50,9 +90,11 @@ class Hook:
     def from_dict(data: dict) -> 'Hook':
         return Hook(**data)
     
-    def is_expired(self) -> bool:
+    def is_expired(self, now_ts: Optional[float] = None) -> bool:
         """检查是否过期（超过7天未触发）"""
-        return (datetime.now().timestamp() - self.created_at) > 604800  # 7天
+        if now_ts is None:
+            now_ts = time.time()
+        return (now_ts - self.created_at) > HOOK_TTL_SECONDS
 
 
 class HookerAgent:
@@ -66,15 +108,28 @@ class HookerAgent:
     
     MAX_HOOKS_PER_GROUP = 5
     HOOKS_DIR = "data/hooks"
+    HOOKS_FILE = "hooks.json"   # 快照
+    HOOKS_LOG = "hooks.log"     # 增量操作日志 (JSONL)
+    COMPACT_EVERY = 100         # 每累计多少次增量写入后压缩一次
     
     def __init__(self):
         self.hooks: Dict[str, Hook] = {}  # {hook_id: Hook}
-        self.group_hooks: Dict[int, List[str]] = {}  # {group_id: [hook_ids]}
+        self.group_hooks: Dict[int, Set[str]] = {}  # {group_id: {未触发的 hook_ids}}
         self._running = False
         self._monitor_task: Optional[asyncio.Task] = None
         self._message_callback: Optional[Callable] = None
         self._db = None
         self._llm_service = None  # LLM 服务引用（优先使用）
+        self._ops_since_compact = 0
+        self._dirty_ops: List[dict] = []  # 等待落盘的增量日志（按产生顺序）
+        self._save_lock = asyncio.Lock()  # 串行化线程中的日志写入，保证顺序
+        self._flush_tasks: Set[asyncio.Task] = set()
+        self._pending_kw: Dict[int, Dict[str, List[str]]] = {}  # {group_id: {keyword: [hook_ids]}}
+        self._group_kw_matcher: Dict[int, Any] = {}  # {group_id: 关键词匹配器}
+        self._time_heap: List[tuple] = []  # [(检查时间戳, hook_id)] 最小堆，条目惰性删除
+        self._group_version: Dict[int, int] = {}  # {group_id: 版本号}，群组 Hook 变化时递增
+        self._ai_list_cache: Dict[int, tuple] = {}  # {group_id: (版本号, 渲染结果)}
+        self._group_locks: Dict[int, asyncio.Lock] = {}  # {group_id: 发送锁}
         
         # 确保目录存在
         os.makedirs(self.HOOKS_DIR, exist_ok=True)
@@ -96,59 +151,233 @@ class HookerAgent:
         self._message_callback = callback
     
     def _load_hooks(self):
-        """从本地加载持久化的 hooks"""
-        hooks_file = os.path.join(self.HOOKS_DIR, "hooks.json")
-        if os.path.exists(hooks_file):
-            try:
-                with open(hooks_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    for hook_data in data.get("hooks", []):
-                        hook = Hook.from_dict(hook_data)
-                        if not hook.triggered and not hook.is_expired():
-                            self.hooks[hook.hook_id] = hook
-                            if hook.group_id not in self.group_hooks:
-                                self.group_hooks[hook.group_id] = []
-                            self.group_hooks[hook.group_id].append(hook.hook_id)
-                logger.info(f"[HookerAgent] Loaded {len(self.hooks)} pending hooks")
-            except Exception as e:
-                logger.error(f"[HookerAgent] Failed to load hooks: {e}")
-    
-    def _save_hooks(self):
-        """持久化 hooks 到本地"""
-        hooks_file = os.path.join(self.HOOKS_DIR, "hooks.json")
+        """从本地加载持久化的 hooks（快照 + 回放增量日志）"""
+        hooks_file = os.path.join(self.HOOKS_DIR, self.HOOKS_FILE)
+        log_file = os.path.join(self.HOOKS_DIR, self.HOOKS_LOG)
+        loaded: Dict[str, Hook] = {}
+        try:
+            if os.path.exists(hooks_file):
+                with open(hooks_file, "rb") as f:
+                    data = _loads(f.read())
+                for hook_data in data.get("hooks", []):
+                    hook = Hook.from_dict(hook_data)
+                    loaded[hook.hook_id] = hook
+            
+            if os.path.exists(log_file):
+                with open(log_file, "rb") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            self._apply_op(loaded, _loads(line))
+                        except Exception as e:
+                            # 崩溃时可能留下写了一半的最后一行，跳过即可
+                            logger.warning(f"[HookerAgent] Skipping bad hook log entry: {e}")
+        except Exception as e:
+            logger.error(f"[HookerAgent] Failed to load hooks: {e}")
+        
+        now_ts = time.time()
+        for hook in loaded.values():
+            if not hook.triggered and not hook.is_expired(now_ts):
+                if hook.trigger_type == _TT_TIME and not hook.trigger_ts:
+                    try:
+                        hook.trigger_ts = datetime.fromisoformat(hook.trigger_value).timestamp()
+                    except ValueError as e:
+                        logger.error(f"[HookerAgent] Failed to parse time for hook {hook.hook_id}: {e}")
+                self.hooks[hook.hook_id] = hook
+                self._index_hook(hook)
+        logger.info(f"[HookerAgent] Loaded {len(self.hooks)} pending hooks")
+        
+        # 启动时把日志合并进快照，避免日志无限增长
+        if os.path.exists(log_file):
+            self._compact()
+    
+    @staticmethod
+    def _apply_op(hooks: Dict[str, Hook], op: dict):
+        """将一条增量日志应用到 hooks 字典"""
+        kind = op.get("op")
+        if kind == "put":
+            hook = Hook.from_dict(op["hook"])
+            hooks[hook.hook_id] = hook
+        elif kind == "trigger":
+            hook = hooks.get(op["id"])
+            if hook:
+                hook.triggered = True
+                hook.trigger_time = op.get("t")
+        elif kind == "del":
+            hooks.pop(op["id"], None)
+    
+    def _save_hooks(self) -> bool:
+        """持久化全部 hooks 快照到本地（先写临时文件再原子替换）"""
+        hooks_file = os.path.join(self.HOOKS_DIR, self.HOOKS_FILE)
+        tmp_file = hooks_file + ".tmp"
         try:
             data = {
                 "hooks": [hook.to_dict() for hook in self.hooks.values()],
                 "last_updated": datetime.now().isoformat()
             }
-            with open(hooks_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with open(tmp_file, "wb") as f:
+                f.write(_dumps(data))
+            os.replace(tmp_file, hooks_file)
+            return True
         except Exception as e:
             logger.error(f"[HookerAgent] Failed to save hooks: {e}")
+            return False
+    
+    def _compact(self):
+        """写入新快照并清空增量日志"""
+        if not self._save_hooks():
+            return
+        try:
+            open(os.path.join(self.HOOKS_DIR, self.HOOKS_LOG), "wb").close()
+        except Exception as e:
+            logger.error(f"[HookerAgent] Failed to truncate hook log: {e}")
+        self._ops_since_compact = 0
+    
+    def _write_log(self, ops: List[dict]) -> bool:
+        """一次写入追加多条增量日志（只做文件 I/O，可在线程中执行）"""
+        try:
+            with open(os.path.join(self.HOOKS_DIR, self.HOOKS_LOG), "ab") as f:
+                f.write(b"".join(_dumps_line(op) + b"\n" for op in ops))
+            return True
+        except Exception as e:
+            logger.error(f"[HookerAgent] Failed to append hook log: {e}")
+            return False
+    
+    def _after_append(self, count: int):
+        """累计增量日志条数，达到阈值后压缩"""
+        self._ops_since_compact += count
+        if self._ops_since_compact >= self.COMPACT_EVERY:
+            self._compact()
+    
+    def _flush_dirty(self):
+        """在当前线程立即写出缓冲中的增量日志（没有事件循环时使用）"""
+        if self._dirty_ops:
+            ops, self._dirty_ops = self._dirty_ops, []
+            if self._write_log(ops):
+                self._after_append(len(ops))
+    
+    async def _flush_dirty_async(self):
+        """在线程中写出缓冲中的增量日志，不阻塞事件循环"""
+        async with self._save_lock:
+            if not self._dirty_ops:
+                return
+            ops, self._dirty_ops = self._dirty_ops, []
+            ok = await asyncio.to_thread(self._write_log, ops)
+        if ok:
+            self._after_append(len(ops))
+    
+    def _request_flush(self):
+        """供同步方法调用：有事件循环时在后台写出，否则立即写出"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush_dirty()
+            return
+        task = loop.create_task(self._flush_dirty_async())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    def _append_hook(self, hook: Hook):
+        """记录新建/修改的 Hook"""
+        self._dirty_ops.append({"op": "put", "hook": hook.to_dict()})
+    
+    def _mark_triggered(self, hooks: List[Hook]):
+        """记录一批 Hook 已触发"""
+        self._dirty_ops.extend({"op": "trigger", "id": h.hook_id, "t": h.trigger_time} for h in hooks)
+    
+    def _mark_removed(self, hook_id: str):
+        """记录 Hook 已取消"""
+        self._dirty_ops.append({"op": "del", "id": hook_id})
+    
+    def _index_hook(self, hook: Hook):
+        """把未触发的 Hook 加入群组索引、关键词索引和时间堆"""
+        self._touch_group(hook.group_id)
+        self.group_hooks.setdefault(hook.group_id, set()).add(hook.hook_id)
+        if hook.trigger_type == _TT_KEYWORD:
+            self._add_pending_keyword(hook)
+        self._schedule(hook)
+    
+    def _unindex_hook(self, hook: Hook):
+        """Hook 触发/取消/过期后立即移出待触发索引（时间堆条目惰性删除）"""
+        self._touch_group(hook.group_id)
+        hook_ids = self.group_hooks.get(hook.group_id)
+        if hook_ids is not None:
+            hook_ids.discard(hook.hook_id)
+        if hook.trigger_type == _TT_KEYWORD:
+            self._remove_pending_keyword(hook)
+    
+    def _touch_group(self, group_id: int):
+        """群组 Hook 发生变化，使 get_hooks_list_for_ai 的缓存失效"""
+        self._group_version[group_id] = self._group_version.get(group_id, 0) + 1
+    
+    def _add_pending_keyword(self, hook: Hook):
+        """登记关键词 Hook 到群组关键词索引"""
+        if not hook.trigger_value:
+            return
+        kw_index = self._pending_kw.setdefault(hook.group_id, {})
+        kw_index.setdefault(hook.trigger_value, []).append(hook.hook_id)
+        self._invalidate_keyword_matcher(hook.group_id)
+    
+    def _remove_pending_keyword(self, hook: Hook):
+        """从群组关键词索引中移除关键词 Hook"""
+        kw_index = self._pending_kw.get(hook.group_id)
+        if not kw_index:
+            return
+        hook_ids = kw_index.get(hook.trigger_value)
+        if hook_ids and hook.hook_id in hook_ids:
+            hook_ids.remove(hook.hook_id)
+            if not hook_ids:
+                del kw_index[hook.trigger_value]
+        if not kw_index:
+            del self._pending_kw[hook.group_id]
+        self._invalidate_keyword_matcher(hook.group_id)
+    
+    def _schedule(self, hook: Hook):
+        """
+        将 Hook 的下一次检查时间放入最小堆
+        
+        时间触发：目标时间；关键词触发：过期时间。
+        旧条目不删除，出堆时再校验。
+        """
+        if hook.trigger_type == _TT_TIME and hook.trigger_ts:
+            ts = hook.trigger_ts
+        else:
+            ts = hook.created_at + HOOK_TTL_SECONDS
+        heapq.heappush(self._time_heap, (ts, hook.hook_id))
     
     def get_group_pending_hooks(self, group_id: int) -> List[Hook]:
         """获取群组的未触发 hooks"""
-        hook_ids = self.group_hooks.get(group_id, [])
-        return [self.hooks[hid] for hid in hook_ids if hid in self.hooks and not self.hooks[hid].triggered]
+        hook_ids = self.group_hooks.get(group_id, ())
+        hooks = [self.hooks[hid] for hid in hook_ids if hid in self.hooks and not self.hooks[hid].triggered]
+        hooks.sort(key=lambda h: h.created_at)
+        return hooks
     
     def get_hooks_list_for_ai(self, group_id: int) -> str:
-        """生成给 AI 看的 hooks 列表 (增强版)"""
+        """生成给 AI 看的 hooks 列表 (增强版)，按群组版本号缓存"""
+        version = self._group_version.get(group_id, 0)
+        cached = self._ai_list_cache.get(group_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        
         hooks = self.get_group_pending_hooks(group_id)
         if not hooks:
-            return "当前群组没有待触发的 Hook。"
-        
-        lines = [f"当前群组有 {len(hooks)}/{self.MAX_HOOKS_PER_GROUP} 个待触发的 Hook:", ""]
-        lines.append("| ID (前8位) | 触发类型 | 触发条件 | 内容主题 |")
-        lines.append("| --- | --- | --- | --- |")
-        
-        for h in hooks:
-            type_str = "时间" if h.trigger_type == TriggerType.TIME.value else "关键词"
-            value_display = h.trigger_value
-            # 只取 ID 前 8 位方便引用
-            lines.append(f"| {h.hook_id[:8]} | {type_str} | {value_display} | {h.content_hint} |")
+            rendered = "当前群组没有待触发的 Hook。"
+        else:
+            lines = [f"当前群组有 {len(hooks)}/{self.MAX_HOOKS_PER_GROUP} 个待触发的 Hook:", ""]
+            lines.append("| ID (前8位) | 触发类型 | 触发条件 | 内容主题 |")
+            lines.append("| --- | --- | --- | --- |")
+            
+            for h in hooks:
+                type_str = "时间" if h.trigger_type == _TT_TIME else "关键词"
+                # 只取 ID 前 8 位方便引用
+                lines.append(f"| {h.hook_id[:8]} | {type_str} | {h.trigger_value} | {h.content_hint} |")
+            
+            lines.append("\n💡 提示：你可以使用 edit_hook 工具来修改已有的 Hook，避免重复创建。")
+            rendered = "\n".join(lines)
         
-        lines.append("\n💡 提示：你可以使用 edit_hook 工具来修改已有的 Hook，避免重复创建。")
-        return "\n".join(lines)
+        self._ai_list_cache[group_id] = (version, rendered)
+        return rendered
     
     def edit_hook(
         self, 
@@ -171,7 +400,7 @@ class HookerAgent:
         """
         # 查找匹配的 Hook
         target_hook = None
-        for hid in self.group_hooks.get(group_id, []):
+        for hid in self.group_hooks.get(group_id, ()):
             if hid in self.hooks and hid.startswith(hook_id_prefix) and not self.hooks[hid].triggered:
                 target_hook = self.hooks[hid]
                 break
@@ -183,17 +412,20 @@ class HookerAgent:
         changes = []
         if new_trigger_value:
             # 如果是时间触发，需要验证格式
-            if target_hook.trigger_type == TriggerType.TIME.value:
+            if target_hook.trigger_type == _TT_TIME:
                 target_dt = self._parse_time_str(new_trigger_value)
                 if not target_dt:
                      return False, f"无效的时间格式: {new_trigger_value}"
                 
                 # 更新时间
-                target_hook.trigger_value = new_trigger_value
-                target_hook.trigger_time = target_dt.timestamp()
+                target_hook.trigger_value = target_dt.isoformat()
+                target_hook.trigger_ts = target_dt.timestamp()
+                self._schedule(target_hook)
                 changes.append(f"触发时间改为 {target_dt}")
             else:
+                self._remove_pending_keyword(target_hook)
                 target_hook.trigger_value = new_trigger_value
+                self._add_pending_keyword(target_hook)
                 changes.append(f"触发关键词改为 '{new_trigger_value}'")
         
         if new_content_hint:
@@ -204,7 +436,9 @@ class HookerAgent:
             return False, "没有提供要修改的内容"
         
         # 持久化
-        self._save_hooks()
+        self._touch_group(group_id)
+        self._append_hook(target_hook)
+        self._request_flush()
         return True, f"Hook 已更新: {', '.join(changes)}"
     
     def _parse_time_str(self, time_str: str) -> Optional[datetime]:
@@ -225,22 +459,16 @@ class HookerAgent:
                 pass
                 
         # 2. 中文相对时间: 10秒后, 5分钟后, 2小时后
-        import re
-        match = re.match(r'(\d+)(秒|分钟|小时|天)后', time_str)
+        match = _CN_REL_TIME_RE.match(time_str)
         if match:
-            val = int(match.group(1))
-            unit = match.group(2)
-            if unit == '秒': return now + timedelta(seconds=val)
-            elif unit == '分钟': return now + timedelta(minutes=val)
-            elif unit == '小时': return now + timedelta(hours=val)
-            elif unit == '天': return now + timedelta(days=val)
+            return now + timedelta(**{_CN_UNIT[match.group(2)]: int(match.group(1))})
             
         # 3. 绝对时间格式
-        for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%H:%M:%S", "%H:%M"]:
+        for fmt in _ABS_FMTS:
             try:
                 # 对纯时间格式，假设是今天
                 dt = datetime.strptime(time_str, fmt)
-                if fmt in ["%H:%M:%S", "%H:%M"]:
+                if fmt in _TIME_ONLY_FMTS:
                     dt = datetime.combine(now.date(), dt.time())
                     if dt <= now: # 如果时间已过，假设是明天
                          dt += timedelta(days=1)
@@ -291,27 +519,27 @@ class HookerAgent:
             return False, f"❌ 目标时间已过期: {target_time} (当前: {datetime.now().strftime('%H:%M:%S')})", None
         
         # 生成 Hook ID
-        hook_id = uuid.uuid4().hex[:16]
+        hook_id = os.urandom(8).hex()
         
         # 创建 Hook 对象
         hook = Hook(
             hook_id=hook_id,
             group_id=group_id,
-            trigger_type=TriggerType.TIME.value,
+            trigger_type=_TT_TIME,
             trigger_value=target_time.isoformat(),
             content_hint=content_hint,
             reason=reason,
-            created_at=datetime.now().timestamp()
+            created_at=time.time(),
+            trigger_ts=target_time.timestamp()
         )
         
         # 存储
         self.hooks[hook_id] = hook
-        if group_id not in self.group_hooks:
-            self.group_hooks[group_id] = []
-        self.group_hooks[group_id].append(hook_id)
+        self._index_hook(hook)
         
         # 持久化
-        self._save_hooks()
+        self._append_hook(hook)
+        await self._flush_dirty_async()
         
         logger.info(f"[HookerAgent] Created time hook {hook_id} for {target_time_str}")
         
@@ -346,27 +574,26 @@ ID: {hook_id[:8]}
             return False, f"❌ 该群组已达到最大 Hook 数量限制 ({self.MAX_HOOKS_PER_GROUP})，请先取消一些旧的 Hook。", None
         
         # 生成 Hook ID
-        hook_id = uuid.uuid4().hex[:16]
+        hook_id = os.urandom(8).hex()
         
         # 创建 Hook 对象
         hook = Hook(
             hook_id=hook_id,
             group_id=group_id,
-            trigger_type=TriggerType.KEYWORD.value,
+            trigger_type=_TT_KEYWORD,
             trigger_value=keyword.strip(),
             content_hint=content_hint,
             reason=reason,
-            created_at=datetime.now().timestamp()
+            created_at=time.time()
         )
         
         # 存储
         self.hooks[hook_id] = hook
-        if group_id not in self.group_hooks:
-            self.group_hooks[group_id] = []
-        self.group_hooks[group_id].append(hook_id)
+        self._index_hook(hook)
         
         # 持久化
-        self._save_hooks()
+        self._append_hook(hook)
+        await self._flush_dirty_async()
         
         logger.info(f"[HookerAgent] Created keyword hook {hook_id} for '{keyword}'")
         
@@ -378,8 +605,16 @@ ID: {hook_id[:8]}
     
     def cancel_hook(self, hook_id: str, group_id: Optional[int] = None) -> tuple[bool, str]:
         """取消一个 Hook"""
-        # 支持前缀匹配
-        matching_ids = [hid for hid in self.hooks.keys() if hid.startswith(hook_id)]
+        # 完整 ID 直接查表；否则在全部 Hook（含已触发的）中做前缀匹配
+        if hook_id in self.hooks:
+            matching_ids = [hook_id]
+        else:
+            matching_ids = [hid for hid in self.hooks if hid.startswith(hook_id)]
+            if group_id is not None and len(matching_ids) > 1:
+                # 指定群组时，前缀歧义只在本群 Hook 之间判断
+                own_ids = [hid for hid in matching_ids if self.hooks[hid].group_id == group_id]
+                if own_ids:
+                    matching_ids = own_ids
         
         if not matching_ids:
             return False, f"未找到 Hook: {hook_id}"
@@ -396,86 +631,139 @@ ID: {hook_id[:8]}
         if group_id is not None and hook.group_id != group_id:
             return False, f"该 Hook 不属于当前群组"
         
-        # 从存储中移除
+        # 从存储和待触发索引中移除（时间堆条目出堆时发现 Hook 已不存在会直接丢弃）
         del self.hooks[full_id]
-        if hook.group_id in self.group_hooks:
-            self.group_hooks[hook.group_id] = [
-                hid for hid in self.group_hooks[hook.group_id] if hid != full_id
-            ]
+        self._unindex_hook(hook)
         
         # 持久化
-        self._save_hooks()
+        self._mark_removed(full_id)
+        self._request_flush()
         
         logger.info(f"[HookerAgent] Cancelled hook {full_id}")
         return True, f"✅ 已取消 Hook: {full_id[:8]}"
     
+    def _invalidate_keyword_matcher(self, group_id: int):
+        """群组关键词 Hook 变化后，丢弃缓存的匹配器"""
+        self._group_kw_matcher.pop(group_id, None)
+    
+    def _keyword_matcher(self, group_id: int):
+        """
+        获取群组的关键词匹配器（按需重建）
+        
+        安装了 pyahocorasick 时为 Aho-Corasick 自动机，一次扫描匹配所有关键词；
+        否则为 {keyword: [hook_ids]} 字典。
+        """
+        keywords = self._pending_kw.get(group_id)
+        if not keywords or ahocorasick is None:
+            return keywords
+        
+        matcher = self._group_kw_matcher.get(group_id)
+        if matcher is None:
+            matcher = ahocorasick.Automaton()
+            for keyword, hids in keywords.items():
+                matcher.add_word(keyword, list(hids))
+            matcher.make_automaton()
+            self._group_kw_matcher[group_id] = matcher
+        return matcher
+    
     async def check_message_for_keyword_hooks(self, group_id: int, message_text: str):
         """
         检查消息是否触发关键词 Hook
         
         应该在消息处理流程中调用此方法
         """
-        triggered_hooks = []
+        # 绝大多数群没有关键词 Hook，一次字典查找即可返回
+        if not self._pending_kw.get(group_id):
+            return
         
-        for hook_id, hook in list(self.hooks.items()):
-            if hook.triggered or hook.group_id != group_id:
-                continue
-            
-            if hook.trigger_type == TriggerType.KEYWORD.value:
-                # 检查关键词是否在消息中
-                if hook.trigger_value in message_text:
-                    triggered_hooks.append(hook)
-                    hook.triggered = True
-                    hook.trigger_time = datetime.now().timestamp()
-                    logger.info(f"[HookerAgent] Keyword hook {hook_id} triggered by message: {message_text[:50]}")
+        matcher = self._keyword_matcher(group_id)
         
-        # 触发消息发送
-        for hook in triggered_hooks:
-            await self._trigger_hook_with_llm(hook)
+        if isinstance(matcher, dict):
+            hit_ids = [hid for kw, hids in matcher.items() if kw in message_text for hid in hids]
+        else:
+            hit_ids = [hid for _, hids in matcher.iter(message_text) for hid in hids]
+        
+        now_ts = time.time()
+        triggered_hooks = []
+        for hook_id in dict.fromkeys(hit_ids):
+            hook = self.hooks.get(hook_id)
+            if not hook or hook.triggered:
+                continue
+            triggered_hooks.append(hook)
+            hook.triggered = True
+            hook.trigger_time = now_ts
+            self._unindex_hook(hook)
+            logger.info(f"[HookerAgent] Keyword hook {hook_id} triggered by message: {message_text[:50]}")
         
-        # 保存状态
         if triggered_hooks:
-            self._save_hooks()
+            self._mark_triggered(triggered_hooks)
+        
+        # 触发消息发送
+        await self._trigger_hooks(triggered_hooks)
     
     async def check_and_trigger_time_hooks(self):
-        """检查并触发满足时间条件的 hooks"""
-        current_time = datetime.now()
+        """检查并触发满足时间条件的 hooks（只处理堆顶已到期的条目）"""
+        now_ts = time.time()
         triggered_hooks = []
         
-        for hook_id, hook in list(self.hooks.items()):
-            if hook.triggered:
+        while self._time_heap and self._time_heap[0][0] <= now_ts:
+            _, hook_id = heapq.heappop(self._time_heap)
+            hook = self.hooks.get(hook_id)
+            # 已取消或已触发的旧条目直接丢弃
+            if not hook or hook.triggered:
                 continue
             
             # 检查是否过期
-            if hook.is_expired():
+            if hook.is_expired(now_ts):
                 logger.info(f"[HookerAgent] Hook {hook_id} expired, removing")
                 hook.triggered = True
+                self._unindex_hook(hook)
                 continue
             
-            # 检查时间触发类型
-            if hook.trigger_type == TriggerType.TIME.value:
-                try:
-                    target_time = datetime.fromisoformat(hook.trigger_value)
-                    
-                    # 检查是否到达目标时间
-                    if current_time >= target_time:
-                        triggered_hooks.append(hook)
-                        
-                        # 立即标记为已触发并保存状态
-                        # 防止消息发送过程中的崩溃导致重复触发或状态不一致
-                        hook.triggered = True
-                        hook.trigger_time = datetime.now().timestamp()
-                        logger.info(f"[HookerAgent] Time hook {hook_id} triggered at {current_time}")
-                        self._save_hooks()
-                except Exception as e:
-                    logger.error(f"[HookerAgent] Failed to parse time for hook {hook_id}: {e}")
-        
-        # 触发消息发送 (串行处理，互不影响)
-        for hook in triggered_hooks:
-            try:
-                await self._trigger_hook_with_llm(hook)
-            except Exception as e:
-                logger.error(f"[HookerAgent] Failed to trigger hook {hook.hook_id}: {e}")
+            if hook.trigger_type != _TT_TIME:
+                # 关键词 Hook 尚未过期（时钟回拨等），重新排期
+                self._schedule(hook)
+                continue
+            
+            # 时间已被 edit_hook 推后（新的条目仍在堆中），或时间无法解析
+            if not hook.trigger_ts or now_ts < hook.trigger_ts:
+                continue
+            
+            triggered_hooks.append(hook)
+            
+            hook.triggered = True
+            hook.trigger_time = now_ts
+            self._unindex_hook(hook)
+            logger.info(f"[HookerAgent] Time hook {hook_id} triggered at {datetime.fromtimestamp(now_ts)}")
+        
+        # 发送前统一落盘一次
+        # 防止消息发送过程中的崩溃导致重复触发或状态不一致
+        if triggered_hooks:
+            self._mark_triggered(triggered_hooks)
+            await self._flush_dirty_async()
+        
+        # 触发消息发送 (各群并行，群内按顺序)
+        await self._trigger_hooks(triggered_hooks)
+    
+    async def _trigger_hooks(self, hooks: List[Hook]):
+        """并发触发一批 Hook，同一群组内通过锁保持先后顺序"""
+        if not hooks:
+            return
+        results = await asyncio.gather(
+            *[self._trigger_with_lock(hook) for hook in hooks],
+            return_exceptions=True
+        )
+        for hook, result in zip(hooks, results):
+            if isinstance(result, Exception):
+                logger.error(f"[HookerAgent] Failed to trigger hook {hook.hook_id}: {result}")
+    
+    async def _trigger_with_lock(self, hook: Hook):
+        """持有群组锁发送，避免一个群的慢发送阻塞其它群"""
+        lock = self._group_locks.get(hook.group_id)
+        if lock is None:
+            lock = self._group_locks[hook.group_id] = asyncio.Lock()
+        async with lock:
+            await self._trigger_hook_with_llm(hook)
     
     async def _trigger_hook_with_llm(self, hook: Hook):
         """使用 LLM 服务生成消息并发送（保持人设和上下文）"""
@@ -512,20 +800,30 @@ ID: {hook_id[:8]}
                 await self._monitor_task
             except asyncio.CancelledError:
                 pass
+        self._compact()
         logger.info("[HookerAgent] Monitoring stopped")
     
+    def _next_check_delay(self) -> float:
+        """距离堆顶条目到期的秒数，限制在 [0.5, 5] 之间"""
+        if not self._time_heap:
+            return 5.0
+        return max(0.5, min(5.0, self._time_heap[0][0] - time.time()))
+    
     async def _monitoring_loop(self):
         """监控循环（只检查时间触发）"""
-        ticks = 0
+        last_heartbeat = 0.0
         logger.info("[HookerAgent] Worker loop started")
         
         while self._running:
             try:
                 # 心跳日志 (每 60 秒)
-                if ticks % 12 == 0:
+                if time.time() - last_heartbeat >= 60:
+                    last_heartbeat = time.time()
                     logger.info("[HookerAgent] Worker heartbeat - scanning hooks...")
                 
                 await self.check_and_trigger_time_hooks()
+                # 合并写出消息路径上积累的关键词触发记录
+                await self._flush_dirty_async()
                 
             except asyncio.CancelledError:
                 logger.info("[HookerAgent] Worker task cancelled")
@@ -536,10 +834,9 @@ ID: {hook_id[:8]}
                 import traceback
                 traceback.print_exc()
             
-            ticks += 1
-            # 每 5 秒检查一次
+            # 睡到下一个 Hook 到期（最长 5 秒）
             try:
-                await asyncio.sleep(5)
+                await asyncio.sleep(self._next_check_delay())
             except asyncio.CancelledError:
                 break
 
@@ -1,17 +1,92 @@
 """
 Skill Agent - 专门负责工具调用与任务执行的独立智能体
 """
+import asyncio
+import inspect
 import logging
 import json
 import re
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Set
 from ..config import config
+
+try:
+    import orjson
+
+    def _dumps(data) -> str:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    _loads = orjson.loads
+except ImportError:  # orjson 未安装时回退到标准库
+    def _dumps(data) -> str:
+        return json.dumps(data, ensure_ascii=False)
+
+    _loads = json.loads
+
+logger = logging.getLogger("SkillAgent")
+
+
+class _StreamStopScanner:
+    """
+    增量判断流式输出是否已到达终止点（思考块中的标签不算）
+    只保留尚未定论的尾部文本，每个分片只扫描新增内容，避免反复拼接全文
+    """
+
+    _OPEN_RE = re.compile(r'<(details|think)')
+
+    def __init__(self, stop_re: "re.Pattern"):
+        self._stop_re = stop_re
+        self._tail = ''
+        self._close: Optional[str] = None  # 当前所处思考块的闭合标签
+
+    def feed(self, piece: str) -> bool:
+        tail = self._tail + piece
+        while True:
+            if self._close is not None:
+                end = tail.find(self._close)
+                if end == -1:
+                    self._tail = tail[-(len(self._close) - 1):]
+                    return False
+                tail = tail[end + len(self._close):]
+                self._close = None
+            m = self._OPEN_RE.search(tail)
+            if self._stop_re.search(tail if m is None else tail[:m.start()]):
+                return True
+            if m is None:
+                break
+            self._close = f'</{m.group(1)}>'
+            tail = tail[m.end():]
+        # 保留可能跨分片的部分：未闭合的 [FINISH: ...、末尾的 "[" 开头片段或不完整的起始标签
+        keep = tail.rfind('[FINISH:')
+        if keep == -1:
+            keep = tail.rfind('[')
+        if keep == -1:
+            keep = len(tail)
+        self._tail = tail[min(keep, max(len(tail) - 8, 0)):]
+        return False
+
+
 class SkillAgent:
     """
     Skill Agent 负责接收主 Agent (琪露诺) 的请求，自主规划并执行工具调用。
     采用 ReAct (Reason + Act) 模式进行多步推理。
     """
 
+    # 工具调用: [TOOL_NAME: {json}]（支持换行），这里只匹配到参数的起始 "{"
+    _TOOL_ANCHOR_RE = re.compile(r'\[([a-zA-Z0-9_]+):\s*\{')
+    # 括号匹配时需要关注的字符
+    _BRACE_SCAN_RE = re.compile(r'[{}"\'\\]')
+    # 最终结果: [FINISH: ...]
+    _FINISH_RE = re.compile(r'\[FINISH:(.*?)\]', re.DOTALL)
+    # 流式生成的提前终止点: FINISH 已闭合，或模型开始自行编造工具结果
+    _STREAM_STOP_RE = re.compile(r'\[FINISH:.*?\]|\[Tool Result', re.DOTALL)
+    # 思考内容 (<think>/<details>)，其中的标签不作数
+    _THINK_RE = re.compile(r'<(details|think).*?</\1>', re.DOTALL)
+    # 只读工具，同一轮内可并发执行；其余工具有副作用，按出现顺序串行执行
+    _PURE_TOOLS = frozenset({
+        "look_at_image", "search_web", "fetch_page",
+        "view_chat_history", "recall_knowledge", "recall_user_memory", "list_hooks",
+    })
+
     SYSTEM_PROMPT = """
 你是一个**全能的工具执行专家 (Skill Agent)**。你的职责是帮助主 Agent (琪露诺) 完成各种需要外部工具的任务。
 主 Agent 负责与用户的情感交流，而你负责**干脏活累活**——搜索、看图、记忆管理、定时任务等。
@@ -131,15 +206,24 @@ Skill Agent 结束：
 ```
 """
 
-    def __init__(self, tool_handlers: Dict[str, Callable], call_llm_handler: Callable = None):
+    def __init__(self, tool_handlers: Dict[str, Callable], call_llm_handler: Callable = None, stream_llm_handler: Callable = None):
         self.tool_handlers = tool_handlers
         self.call_llm_handler = call_llm_handler
+        # 流式调用 (messages, group_id=) -> 异步迭代文本片段；可用时优先使用，以便提前结束生成
+        self.stream_llm_handler = stream_llm_handler
         self.model = config.llm.model
         # 限制最大轮数防止死循环
         self.max_steps = 8
         self._running_tasks: Dict[str, str] = {}  # task_id -> description
+        # 限制同时执行的后台任务数；排队任务也计入 _running_tasks
+        self._task_semaphore = asyncio.Semaphore(config.skill.max_concurrent_tasks)
+        # 持有后台任务的强引用，避免任务在完成前被垃圾回收
+        self._task_refs: Set[asyncio.Task] = set()
         self._message_callback: Optional[Callable] = None
         self._task_counter = 0
+        # 工具处理函数元数据 {name: (handler, is_async, accepts_var_kw, param_names)}
+        # 工具可能在初始化后才注册，按需计算
+        self._handler_meta: Dict[str, tuple] = {}
 
     async def execute_task(self, task_description: str, context_info: Dict[str, Any] = None) -> str:
         """
@@ -151,9 +235,10 @@ Skill Agent 结束：
         logger.info(f"[SkillAgent] New Task: {task_description}")
         
         # 构建初始上下文
+        # system 提示词固定不变，且每一步都原样放在最前面，便于服务端前缀缓存命中
         messages = [
             {"role": "system", "content": self.SYSTEM_PROMPT},
-            {"role": "user", "content": f"Task: {task_description}\nContext: {json.dumps(context_info, ensure_ascii=False) if context_info else 'None'}"}
+            {"role": "user", "content": f"Task: {task_description}\nContext: {self._format_context(context_info) if context_info else 'None'}"}
         ]
 
         step = 0
@@ -162,13 +247,22 @@ Skill Agent 结束：
             
             # 1. 调用 LLM 获取思考和行动
             group_id = context_info.get('group_id') if context_info else 0
-            response = await self._call_llm(messages, group_id=group_id)
+            try:
+                response = await asyncio.wait_for(
+                    self._call_llm(messages, group_id=group_id), timeout=config.skill.step_timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"[SkillAgent] Step {step} LLM call timed out after {config.skill.step_timeout}s")
+                # 此时最后一条必然是 user 消息（任务或工具结果），合并进去以保持角色交替
+                last = messages[-1]
+                messages[-1] = {**last, "content": f"{last['content']}\n[System: LLM timeout, please reconsider and continue.]"}
+                continue
             
             # 将 AI 的回复加入历史
             messages.append({"role": "assistant", "content": response})
             
             # 2. 解析 FINISH
-            finish_match = re.search(r'\[FINISH:(.*?)\]', response, re.DOTALL)
+            finish_match = self._FINISH_RE.search(response)
             if finish_match:
                 result = finish_match.group(1).strip()
                 logger.info(f"[SkillAgent] Task Finished: {result[:50]}...")
@@ -185,19 +279,64 @@ Skill Agent 结束：
                 continue
 
             # 执行所有工具调用
-            tool_results = []
-            for tool_name, args_str in tool_calls:
-                result = await self._execute_tool(tool_name, args_str)
-                tool_results.append(f"Tool '{tool_name}' Result: {result}")
+            results = await self._execute_tools(tool_calls)
+            tool_results = [
+                f"Tool '{tool_name}' Result: {result}"
+                for (tool_name, _), result in zip(tool_calls, results)
+            ]
             
             # 将结果加入历史
             messages.append({"role": "user", "content": "\n".join(tool_results)})
         
         return "任务执行达到最大步骤限制，部分完成或失败。"
 
+    @staticmethod
+    def _format_context(context_info: Dict[str, Any]) -> str:
+        """
+        序列化 context_info
+        chat_history_snippet_json 已是序列化好的 JSON 文本，直接拼接为 chat_history_snippet 字段
+        """
+        snippet = context_info.get("chat_history_snippet_json")
+        if snippet is None:
+            return _dumps(context_info)
+        
+        rest = {k: v for k, v in context_info.items() if k != "chat_history_snippet_json"}
+        body = _dumps(rest)
+        sep = ", " if rest else ""
+        return f'{body[:-1]}{sep}"chat_history_snippet": {snippet}}}'
+
+    async def _stream_response(self, messages: List[Dict], group_id: int = 0) -> str:
+        """
+        流式获取回复，FINISH 闭合或模型开始编造工具结果时立即停止生成
+        工具调用不在此处截断，以保留同一轮的多个调用
+        """
+        pieces = []
+        scanner = _StreamStopScanner(self._STREAM_STOP_RE)
+        stream = self.stream_llm_handler(messages, group_id=group_id)
+        try:
+            async for piece in stream:
+                pieces.append(piece)
+                if scanner.feed(piece):
+                    logger.info("[SkillAgent] Stop marker reached, closing stream early")
+                    break
+        finally:
+            await stream.aclose()
+        text = self._THINK_RE.sub('', ''.join(pieces))
+        # 丢弃模型自行编造的工具结果
+        fake_result = text.find('[Tool Result')
+        if fake_result != -1:
+            text = text[:fake_result]
+        return text.strip()
+
     async def _call_llm(self, messages: List[Dict], group_id: int = 0) -> str:
         """调用 LLM 生成回复"""
         try:
+            if self.stream_llm_handler:
+                response = await self._stream_response(messages, group_id=group_id)
+                if response:
+                    return response
+                logger.warning("[SkillAgent] Empty streamed response, falling back to non-streaming call")
+            
             if self.call_llm_handler:
                 return await self.call_llm_handler(messages, group_id=group_id)
             
@@ -208,17 +347,110 @@ Skill Agent 结束：
             logger.error(f"[SkillAgent] LLM Call Failed: {e}")
             return f"<error>{str(e)}</error>"
 
+    @classmethod
+    def _match_braces(cls, text: str, start: int) -> int:
+        """
+        从 start 处的 "{" 开始做括号匹配，字符串（单/双引号）内的括号不计
+        返回闭合 "}" 之后的位置，未闭合返回 -1
+        """
+        depth = 0
+        quote = None
+        pos = start
+        scan = cls._BRACE_SCAN_RE.search
+        while True:
+            m = scan(text, pos)
+            if m is None:
+                return -1
+            ch = m.group()
+            pos = m.end()
+            if quote:
+                if ch == '\\':
+                    pos += 1  # 跳过被转义的字符
+                elif ch == quote:
+                    quote = None
+            elif ch == '"' or ch == "'":
+                quote = ch
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    return pos
+
     def _parse_tool_calls(self, text: str) -> List[tuple]:
-        """解析工具调用"""
+        """解析工具调用：定位 [TOOL_NAME: 后对 JSON 参数做括号匹配，参数中可以含有 ] 或嵌套的 {}"""
         calls = []
-        # 改尽量词正则，支持换行
-        pattern = r'\[([a-zA-Z0-9_]+):\s*(\{.*?\})\]'
-        matches = re.finditer(pattern, text, re.DOTALL)
-        for match in matches:
-            tool_name = match.group(1)
-            args_str = match.group(2)
-            calls.append((tool_name, args_str))
-        return calls
+        pos = 0
+        length = len(text)
+        while True:
+            anchor = self._TOOL_ANCHOR_RE.search(text, pos)
+            if anchor is None:
+                return calls
+            args_start = anchor.end() - 1
+            args_end = self._match_braces(text, args_start)
+            if args_end == -1:
+                # 未闭合（例如参数里有落单的引号），跳过这个锚点继续找后面的调用
+                pos = anchor.end()
+                continue
+            close = args_end
+            while close < length and text[close].isspace():
+                close += 1
+            if close < length and text[close] == ']':
+                calls.append((anchor.group(1), text[args_start:args_end]))
+                pos = close + 1
+            else:
+                pos = anchor.end()
+
+    def _get_handler_meta(self, name: str, handler: Callable) -> tuple:
+        """
+        获取工具处理函数的元数据（按工具缓存，处理函数被替换时重新计算）
+        返回 (handler, 是否为协程, 是否接受 **kwargs, 参数名集合)
+        """
+        cached = self._handler_meta.get(name)
+        if cached is not None and cached[0] is handler:
+            return cached
+        # 工具类实例本身不是函数，需要检查其 async __call__
+        is_async = inspect.iscoroutinefunction(handler) or inspect.iscoroutinefunction(getattr(handler, "__call__", None))
+        try:
+            params = inspect.signature(handler).parameters
+            accepts_var_kw = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values())
+            param_names = frozenset(params)
+        except (TypeError, ValueError):
+            # 无法获取签名时按关键字参数调用
+            accepts_var_kw, param_names = True, frozenset()
+        meta = (handler, is_async, accepts_var_kw, param_names)
+        self._handler_meta[name] = meta
+        return meta
+
+    async def _execute_tools(self, tool_calls: List[tuple]) -> List[str]:
+        """
+        执行同一轮的所有工具调用，结果按调用顺序返回
+        有副作用的工具是屏障：按出现顺序单独执行；两个屏障之间连续的只读工具并发执行，
+        保证只读工具看到的是它之前所有写操作完成后的状态
+        """
+        results: List[Optional[str]] = [None] * len(tool_calls)
+
+        async def run_one(i: int):
+            results[i] = await self._execute_tool(*tool_calls[i])
+
+        async def run_batch(indices: List[int]):
+            outcomes = await asyncio.gather(*(run_one(i) for i in indices), return_exceptions=True)
+            for error in outcomes:
+                if isinstance(error, Exception):
+                    logger.error(f"[SkillAgent] Tool batch error: {error}")
+
+        batch: List[int] = []
+        for i, (name, _) in enumerate(tool_calls):
+            if name in self._PURE_TOOLS:
+                batch.append(i)
+                continue
+            if batch:
+                await run_batch(batch)
+                batch = []
+            await run_batch([i])
+        if batch:
+            await run_batch(batch)
+        return [r if r is not None else "Error: tool did not complete" for r in results]
 
     async def _execute_tool(self, name: str, args_str: str) -> str:
         """执行工具"""
@@ -227,24 +459,23 @@ Skill Agent 结束：
         
         try:
             # 尝试解析 JSON 参数
-            # 修复常见的 JSON 格式错误（如单引号）
-            args_str = args_str.replace("'", '"')
-            args = json.loads(args_str)
+            try:
+                args = _loads(args_str)
+            except json.JSONDecodeError:
+                # 修复常见的 JSON 格式错误（如单引号）
+                args = _loads(args_str.replace("'", '"'))
             
             handler = self.tool_handlers[name]
             
-            # 检查 handler 是同步还是异步
-            import inspect
-            if inspect.iscoroutinefunction(handler):
-                try:
-                    result = await handler(**args)
-                except TypeError:
-                    result = await handler(*args.values())
+            _, is_async, accepts_var_kw, param_names = self._get_handler_meta(name, handler)
+            
+            # 根据签名选择调用方式：参数名都能对上时按关键字传入，否则按位置传入
+            if accepts_var_kw or param_names.issuperset(args):
+                result = handler(**args)
             else:
-                try:
-                    result = handler(**args)
-                except TypeError:
-                    result = handler(*args.values())
+                result = handler(*args.values())
+            if is_async:
+                result = await result
                 
             return str(result)
         except json.JSONDecodeError:
@@ -286,8 +517,12 @@ Skill Agent 结束：
             return ""
         return "\n".join(info) + "\n"
 
-    def start_task_background(self, task_description: str, context_info: Dict[str, Any] = None):
-        """后台启动任务（非阻塞）"""
+    def start_task_background(self, task_description: str, context_info: Dict[str, Any] = None) -> Optional[str]:
+        """后台启动任务（非阻塞），任务过多时拒绝并返回 None"""
+        if len(self._running_tasks) >= config.skill.max_pending_tasks:
+            logger.warning(f"[SkillAgent] Too many background tasks ({len(self._running_tasks)}), rejecting: {task_description}")
+            return None
+        
         self._task_counter += 1
         task_id = str(self._task_counter)
         self._running_tasks[task_id] = {
@@ -296,18 +531,21 @@ Skill Agent 结束：
         }
         
         # 启动后台任务
-        import asyncio
-        asyncio.create_task(self._run_background_loop(task_id, task_description, context_info))
+        task = asyncio.create_task(self._run_background_loop(task_id, task_description, context_info))
+        self._task_refs.add(task)
+        task.add_done_callback(self._task_refs.discard)
         
         return task_id
 
     async def _run_background_loop(self, task_id: str, task_description: str, context_info: Dict[str, Any]):
         """后台执行循环"""
-        logger.info(f"[SkillAgent] Background task #{task_id} started: {task_description}")
-        result = await self.execute_task(task_description, context_info)
-        
-        # 任务结束，移除状态
-        self._running_tasks.pop(task_id, None)
+        try:
+            async with self._task_semaphore:
+                logger.info(f"[SkillAgent] Background task #{task_id} started: {task_description}")
+                result = await self.execute_task(task_description, context_info)
+        finally:
+            # 任务结束，移除状态
+            self._running_tasks.pop(task_id, None)
         
         # 通过回调发送结果
         if self._message_callback and context_info:
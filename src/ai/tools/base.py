@@ -1,6 +1,8 @@
-from typing import Callable, Any, Dict
+from typing import Callable, Any, Dict, Optional, Tuple
 import inspect
 import logging
+from openai import AsyncOpenAI
+from ...utils.aio_transport import make_async_client
 
 logger = logging.getLogger("Tools")
 
@@ -9,9 +11,38 @@ class BaseTool:
     name: str = "base_tool"
     description: str = "Base tool description"
     
+    def __init__(self):
+        # 按 (base_url, api_key) 缓存的 OpenAI 兼容客户端，首次使用时创建
+        self._openai_clients: Optional[Dict[Tuple[str, str], AsyncOpenAI]] = None
+    
     async def __call__(self, *args, **kwargs) -> Any:
         raise NotImplementedError
 
+    def _get_openai_client(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        """按 (base_url, api_key) 缓存 OpenAI 兼容客户端，复用连接池避免每次调用重新握手"""
+        if self._openai_clients is None:
+            self._openai_clients = {}
+        clients = self._openai_clients
+        key = (base_url, api_key)
+        client = clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=make_async_client(),
+            )
+            clients[key] = client
+        return client
+
+    async def aclose(self) -> None:
+        """释放工具持有的连接等资源"""
+        clients, self._openai_clients = self._openai_clients, None
+        for client in (clients or {}).values():
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"[Tools] Failed to close client for {self.name}: {e}")
+
 # 工具注册表
 TOOL_REGISTRY: Dict[str, BaseTool] = {}
 
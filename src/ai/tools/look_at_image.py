@@ -1,24 +1,218 @@
 import logging
 import asyncio
-import requests
 import re
 import hashlib
 import base64
 import random
+from functools import partial
 from PIL import Image
 from io import BytesIO
 from .base import BaseTool, register_tool
 from ...config import config, ModelProvider
-from openai import AsyncOpenAI
+from typing import Dict, List
+
+try:
+    import aiohttp
+except ImportError:  # 未安装 aiohttp 时退回 requests + 线程池
+    aiohttp = None
+    import requests
 
 logger = logging.getLogger("Tools.LookAtImage")
 
+_URL_RE = re.compile(r'https?://[^\s\]]+')
+# 添加请求头模拟浏览器，避免被 QQ 图片服务器拒绝
+_DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Referer': 'https://qun.qq.com/',
+    'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+    'Connection': 'keep-alive'
+}
+# 小于该大小的图片直接在事件循环内哈希，线程切换反而更慢
+_INLINE_HASH_LIMIT = 64 * 1024
+# 发送给视觉模型前的最大边长 (像素)，多数视觉模型内部也会缩放到 768~1024
+VISION_MAX_SIDE = 1280
+_VISION_PROMPT = "Describe this image in detail but briefly. Focus on anime style features if present."
+
+
+def _md5_hex(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def _sniff_mime(data: bytes) -> str:
+    """根据文件头魔数判断图片 MIME 类型，无需 PIL 解析"""
+    sig = data[:12]
+    if sig.startswith(b'\xff\xd8'):
+        return "image/jpeg"
+    if sig.startswith(b'\x89PNG'):
+        return "image/png"
+    if sig.startswith(b'GIF8'):
+        return "image/gif"
+    if sig[:4] == b'RIFF' and sig[8:12] == b'WEBP':
+        return "image/webp"
+    if sig.startswith(b'BM'):
+        return "image/bmp"
+    return "image/jpeg" # Fallback
+
+
+def _encode_data_url(data: bytes) -> str:
+    """构建 data URL；长边超过 VISION_MAX_SIDE 的静态图先缩小并转为 JPEG，原始字节仍用于缓存哈希"""
+    # Detect MIME type and Prepare Base64
+    mime_type = _sniff_mime(data)
+    try:
+        img = Image.open(BytesIO(data))
+        if max(img.size) > VISION_MAX_SIDE and not getattr(img, "is_animated", False):
+            img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            out = BytesIO()
+            img.save(out, format="JPEG", quality=85, optimize=True)
+            logger.info(f"[Vision] Downscaled image {len(data)} -> {out.tell()} bytes")
+            data, mime_type = out.getvalue(), "image/jpeg"
+    except Exception as e:
+        logger.warning(f"[Vision] Downscale skipped: {e}")
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+class _VisionImage:
+    """待识别的图片；data URL 与 PIL 图像在首次用到时才构建，且只构建一次"""
+    __slots__ = ("raw", "_data_url", "_pil_image")
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._data_url = None
+        self._pil_image = None
+
+    async def data_url(self) -> str:
+        # 缩放 + base64 在线程池中完成；多个 key 并发请求时共享同一次编码
+        if self._data_url is None:
+            loop = asyncio.get_running_loop()
+            self._data_url = loop.run_in_executor(None, _encode_data_url, self.raw)
+        return await asyncio.shield(self._data_url)
+
+    @property
+    def pil_image(self) -> "Image.Image":
+        # Convert bytes to PIL Image
+        if self._pil_image is None:
+            self._pil_image = Image.open(BytesIO(self.raw))
+        return self._pil_image
+
+
 @register_tool("look_at_image")
 class LookAtImageTool(BaseTool):
     description = "视觉工具：查看图片内容 (带缓存)"
 
+    def __init__(self):
+        super().__init__()
+        # 图片下载共用的 aiohttp 会话，首次下载时在事件循环内创建
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+                headers=_DOWNLOAD_HEADERS,
+            )
+        return self._session
+
+    async def _download(self, image_url: str) -> bytes:
+        if aiohttp is None:
+            def download():
+                resp = requests.get(image_url, headers=_DOWNLOAD_HEADERS, timeout=60, allow_redirects=True)
+                resp.raise_for_status()
+                return resp.content
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, download)
+
+        async with self._get_session().get(image_url, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def aclose(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        await super().aclose()
+
     async def _calculate_image_hash(self, image_bytes: bytes) -> str:
-        return hashlib.md5(image_bytes).hexdigest()
+        # 仍使用 md5：数据库 image_cache 以 md5 为键，换算法会让已有缓存全部失效
+        # 大图哈希放到线程池里做（hashlib 会释放 GIL），避免阻塞事件循环
+        hasher = partial(_md5_hex, image_bytes)
+        if len(image_bytes) < _INLINE_HASH_LIMIT:
+            return hasher()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, hasher)
+
+    async def _describe_with_key(self, candidate: ModelProvider, api_key: str, image: "_VisionImage") -> str:
+        """用单个 key 调用视觉模型，失败时抛出异常"""
+        # Special handling for Native Gemini (if no base_url provided or explicit google provider request without openai url)
+        if candidate.provider == "gemini" and "openai" not in candidate.base_url and not candidate.base_url:
+            logger.info("[Vision] Using Native Gemini Client...")
+            from google import genai
+            client = genai.Client(api_key=api_key)
+            response = await client.aio.models.generate_content(
+                model=candidate.model,
+                contents=[image.pil_image, _VISION_PROMPT]
+            )
+            return response.text
+
+        # Use OpenAI Compatible Client (for OpenAI, ModelScope, and Gemini-OpenAI)
+        logger.info("[Vision] Using OpenAI Compatible Client...")
+        client = self._get_openai_client(candidate.base_url, api_key)
+        response = await client.chat.completions.create(
+            model=candidate.model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": _VISION_PROMPT},
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": await image.data_url()},
+                        },
+                    ],
+                }
+            ],
+            max_tokens=512,
+        )
+        return response.choices[0].message.content
+
+    async def _race_keys(self, candidate: ModelProvider, keys: List[str], image: "_VisionImage") -> str:
+        """
+        依次尝试同一候选的多个 key；配置 vision.key_concurrency > 1 时最多同时进行这么多个
+        某个 key 失败就补上下一个，首个成功结果胜出，其余请求取消
+        """
+        key_iter = iter(keys)
+        running: Dict[asyncio.Task, str] = {}
+
+        def launch_next() -> bool:
+            api_key = next(key_iter, None)
+            if api_key is None:
+                return False
+            running[asyncio.create_task(self._describe_with_key(candidate, api_key, image))] = api_key
+            return True
+
+        for _ in range(max(1, config.vision.key_concurrency)):
+            if not launch_next():
+                break
+
+        try:
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    api_key = running.pop(task)
+                    try:
+                        description = task.result()
+                    except Exception as e:
+                        logger.warning(f"[Vision] Failed with key {api_key[:4]}...: {e}")
+                        description = ""
+                    if description:
+                        return description # Key worked
+                    launch_next() # Try next key
+            return ""
+        finally:
+            for task in running:
+                task.cancel()
 
     async def __call__(self, image_url: str = "", **kwargs):
         service = kwargs.get("service")
@@ -27,24 +221,15 @@ class LookAtImageTool(BaseTool):
 
         # 如果没有提供URL，委托 SkillAgent 查找
         if not image_url and hasattr(service, 'skill_agent') and service.skill_agent:
-            from ..llm_service import active_group_id, current_chat_context
+            from ..llm_service import active_group_id, current_chat_context, build_skill_context
             logger.info("[Vision] No Image URL provided, delegating to SkillAgent...")
-            group_id = active_group_id.get()
-            context = current_chat_context.get()
-            # 取最近 20 条消息作为上下文
-            recent_msgs = context[-20:] if context else []
             
             task_desc = "用户想要看图，但没有提供 specific URL。请分析 Context 找到最近一张用户发送的图片(Image Message)，并提取其 URL (通常在[图片:...]或[IMG:...]标签中)。找到后，请调用 look_at_image 工具并传入正确的 URL。如果找不到图片，请直接告知用户'没看到图片诶'。"
             
+            # 最近 20 条消息直接序列化为 JSON 文本，不再逐条复制消息字典
             result = await service.skill_agent.execute_task(
                 task_desc, 
-                context_info={
-                    "group_id": group_id, 
-                    "chat_history_snippet": [
-                        {"role": m.get("role"), "content": m.get("content")} 
-                        for m in recent_msgs
-                    ]
-                }
+                context_info=build_skill_context(active_group_id.get(), current_chat_context.get())
             )
             return f"[Delegated to SkillAgent]: {result}"
 
@@ -56,7 +241,7 @@ class LookAtImageTool(BaseTool):
             logger.info(f"[Vision] Request to look at image: {image_url}")
             
             # 强化 URL 清洗
-            url_match = re.search(r'https?://[^\s\]]+', image_url)
+            url_match = _URL_RE.search(image_url)
             if url_match:
                 image_url = url_match.group(0)
                 logger.info(f"[Vision] Regex matched URL: {image_url}")
@@ -66,21 +251,7 @@ class LookAtImageTool(BaseTool):
 
             logger.info(f"[Vision] Final downloading URL: {image_url}...")
             
-            def download():
-                # 添加请求头模拟浏览器，避免被 QQ 图片服务器拒绝
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'Referer': 'https://qun.qq.com/',
-                    'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
-                    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-                    'Connection': 'keep-alive'
-                }
-                resp = requests.get(image_url, headers=headers, timeout=60, allow_redirects=True)
-                resp.raise_for_status()
-                return resp.content
-            
-            loop = asyncio.get_running_loop()
-            img_bytes = await loop.run_in_executor(None, download)
+            img_bytes = await self._download(image_url)
             
             # Check Cache
             img_hash = ""
@@ -97,16 +268,7 @@ class LookAtImageTool(BaseTool):
             if not candidates:
                 return "[Vision Failed] 配置中没有启用任何视觉模型 (is_vision_capable=true)"
 
-            # Detect MIME type and Prepare Base64
-            try:
-                pil_img = Image.open(BytesIO(img_bytes))
-                fmt = pil_img.format.lower() if pil_img.format else "jpeg"
-                mime_type = f"image/{fmt}"
-            except Exception:
-                mime_type = "image/jpeg" # Fallback
-
-            img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-            img_data_url = f"data:{mime_type};base64,{img_b64}"
+            image = _VisionImage(img_bytes)
 
             # Iterate candidates
             for candidate in candidates:
@@ -120,52 +282,7 @@ class LookAtImageTool(BaseTool):
                 shuffled_keys = keys.copy()
                 random.shuffle(shuffled_keys)
                 
-                for api_key in shuffled_keys:
-                    try:
-                        # Special handling for Native Gemini (if no base_url provided or explicit google provider request without openai url)
-                        if candidate.provider == "gemini" and "openai" not in candidate.base_url and not candidate.base_url:
-                            logger.info("[Vision] Using Native Gemini Client...")
-                            from google import genai
-                            client = genai.Client(api_key=api_key)
-                            # Convert bytes to PIL Image
-                            image = Image.open(BytesIO(img_bytes))
-                            response = await client.aio.models.generate_content(
-                                model=candidate.model,
-                                contents=[image, "Describe this image in detail but briefly. Focus on anime style features if present."]
-                            )
-                            description = response.text
-                        else:
-                            # Use OpenAI Compatible Client (for OpenAI, ModelScope, and Gemini-OpenAI)
-                            logger.info("[Vision] Using OpenAI Compatible Client...")
-                            client = AsyncOpenAI(
-                                base_url=candidate.base_url,
-                                api_key=api_key,
-                            )
-                            response = await client.chat.completions.create(
-                                model=candidate.model,
-                                messages=[
-                                    {
-                                        "role": "user",
-                                        "content": [
-                                            {"type": "text", "text": "Describe this image in detail but briefly. Focus on anime style features if present."},
-                                            {
-                                                "type": "image_url",
-                                                "image_url": {"url": img_data_url},
-                                            },
-                                        ],
-                                    }
-                                ],
-                                max_tokens=512,
-                            )
-                            description = response.choices[0].message.content
-
-                        if description:
-                            break # Key worked
-                            
-                    except Exception as e:
-                        logger.warning(f"[Vision] Failed with key {api_key[:4]}...: {e}")
-                        continue # Try next key
-                
+                description = await self._race_keys(candidate, shuffled_keys, image)
                 if description:
                     break # Candidate worked
 
@@ -4,7 +4,6 @@ import urllib.parse
 import logging
 import random
 from ...config import config, ModelProvider
-from openai import AsyncOpenAI
 
 logger = logging.getLogger("Tools.SearchWeb")
 
@@ -57,10 +56,7 @@ class SearchWebTool(BaseTool):
                     # Strategy 2: OpenAI Compatible (Perplexity etc.)
                     else:
                         logger.info("[Search] Using OpenAI Compatible Search (e.g. Perplexity)...")
-                        client = AsyncOpenAI(
-                            base_url=candidate.base_url,
-                            api_key=api_key,
-                        )
+                        client = self._get_openai_client(candidate.base_url, api_key)
                         response = await client.chat.completions.create(
                             model=candidate.model,
                             messages=[
@@ -17,19 +17,10 @@ class SkillRequestTool(BaseTool):
         logger.info(f"[SKILL_REQUEST] Goal: {goal}")
         
         # 获取当前上下文
-        from ..llm_service import active_group_id, current_chat_context
-        group_id = active_group_id.get()
-        context = current_chat_context.get()
+        from ..llm_service import active_group_id, current_chat_context, build_skill_context
         
-        # 构建 context_info
-        context_info = {
-            "group_id": group_id,
-            "chat_history_snippet": context[-20:] if context else [],
-        }
-        
-        # 如果有 required_content，添加到 context_info
-        if required_content:
-            context_info["required_content"] = required_content
+        # 构建 context_info（含 required_content）
+        context_info = build_skill_context(active_group_id.get(), current_chat_context.get(), required_content)
         
         # 启动 Skill Agent 后台任务
         if hasattr(service, 'skill_agent') and service.skill_agent:
@@ -37,6 +28,8 @@ class SkillRequestTool(BaseTool):
                 task_description=goal,
                 context_info=context_info
             )
+            if task_id is None:
+                return "❌ 技能助手任务太多了，请稍后再试"
             logger.info(f"[SKILL_REQUEST] Task delegated to Skill Agent (ID: {task_id})")
             return f"✅ 已交给技能助手处理"
         else:
@@ -5,22 +5,253 @@ import os
 import asyncio
 import base64
 import json
+import logging
 import random
+import re
+import sys
+import time
 import traceback
-from typing import Optional
-from datetime import datetime
+import types
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional
 
+import aiocqhttp
+import aiocqhttp.api_impl
 from aiocqhttp import CQHttp, Event, MessageSegment
 
+try:
+    import orjson
+except ImportError:  # orjson 未安装时保持 aiocqhttp 默认的 json
+    orjson = None
+
 from ..config import config
 from ..database.db import Database
+from ..ai.llm_service import llm_service
 from .handler import GameHandler, GameResponse
 
 
+logger = logging.getLogger("Bot")
+
+_LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARN": logging.WARNING,
+           "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+# 低于 LOG_LEVEL 的日志在格式化前即被丢弃；LOG_LEVEL=DEBUG 时才输出逐条消息事件的调试转储
+_LOG_LEVEL = _LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+_DEBUG = _LOG_LEVEL <= logging.DEBUG
+
+
+def _configure_logging():
+    """为 Bot 日志配置唯一的 stdout 输出（不改动根 logger，其它模块的日志行为保持不变）"""
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(handler)
+    logger.setLevel(_LOG_LEVEL)
+    logger.propagate = False
+
+
 def log(level: str, msg: str):
     """简单日志函数"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] [{level}] {msg}")
+    logger.log(_LEVELS.get(level, logging.INFO), msg)
+
+
+def _orjson_dumps(obj, **kwargs) -> str:
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        # orjson 不支持的类型回退到标准库（保留 default 等参数）
+        return json.dumps(obj, **kwargs)
+
+
+def _orjson_loads(data, **kwargs):
+    return json.loads(data, **kwargs) if kwargs else orjson.loads(data)
+
+
+# aiocqhttp 通过 WS 收发 API 调用时用标准库 json 编解码，含 base64 图片的消息体很大；
+# 用 orjson 替换其模块里的 json（其余属性仍指向标准库）
+if orjson is not None:
+    _fast_json = types.SimpleNamespace(**vars(json))
+    _fast_json.dumps = _orjson_dumps
+    _fast_json.loads = _orjson_loads
+    for _mod in (aiocqhttp, aiocqhttp.api_impl):
+        if getattr(_mod, "json", None) is json:
+            _mod.json = _fast_json
+
+
+# [AT: QQ] 标签，同时容错常见格式错误：[AT:123]（缺空格）、[AT 123]（缺冒号）、[at: 123]（大小写）
+_AT_RE = re.compile(r'\[(?:AT\s+|(?i:at):\s*)(\d+)\]')
+# 用户消息元数据中的 QQ 号 "(QQ:ID)["
+_METADATA_QQ_RE = re.compile(r'\(QQ:(\d+)\)\[')
+
+# 出站图片 base64 缓存 {(路径, mtime_ns, 大小): "base64://..."}，表情包等重复图片无需重复读取编码
+_IMG_B64_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_IMG_B64_CACHE_MAX = 256
+# 超过该大小的图片不进缓存，避免占用过多内存
+_IMG_B64_CACHE_FILE_LIMIT = 2 * 1024 * 1024
+
+# 被引用消息 (get_msg) 缓存：同一条消息常被多人先后引用
+_REPLY_CACHE_MAX = 512
+_REPLY_CACHE_TTL = 300.0
+
+# Handler 出站队列容量与消费任务的空闲退出时间（秒）
+_OUT_QUEUE_MAX = 1000
+_OUT_WORKER_IDLE = 300.0
+
+# 合并积压响应时的文本总长度上限，避免单条消息过长
+_MERGE_MAX_CHARS = 4096
+
+
+def _response_text_len(response: GameResponse) -> int:
+    return sum(len(seg.get("text") or "") for seg in response.multi_segments)
+
+
+def _merge_responses(first: GameResponse, nxt: GameResponse) -> GameResponse:
+    """把 nxt 接在 first 之后；nxt 的首个气泡（非逐条发送时为全部气泡）与前一气泡合并"""
+    merged = GameResponse(reply_to=first.reply_to)
+    merged.staggered = first.staggered
+    merged.multi_segments = list(first.multi_segments)
+    for i, seg in enumerate(nxt.multi_segments):
+        if i == 0 or not nxt.staggered:
+            seg = dict(seg, bubble_join=True)
+        merged.multi_segments.append(seg)
+    return merged
+
+
+# 通过好友请求后发送的欢迎语
+_WELCOME_MSGS = (
+    "嘿嘿，你好呀~ 我是琪露诺，最强的冰精灵！有什么想聊的吗？",
+    "哇！是新朋友！你好你好~ 我是⑨哦~",
+    "欢迎欢迎！以后有什么事可以找我聊天哦~",
+)
+
+# 本地图片注册表 {路径: "file:///..."}，image_file_uri 模式下命中时无需 stat / 解析路径
+_IMAGE_REGISTRY: Dict[str, str] = {}
+_MEME_DIR = os.path.join("assets", "memes")
+_IMAGE_EXTS = ('jpg', 'png', 'gif', 'jpeg')
+
+
+def _register_images(base_dir: str) -> int:
+    """预先登记目录下的图片（在线程池中执行），返回登记数量"""
+    count = 0
+    for dirpath, _, filenames in os.walk(base_dir):
+        for name in filenames:
+            if name.endswith(_IMAGE_EXTS):
+                path = os.path.join(dirpath, name)
+                _IMAGE_REGISTRY[path] = Path(path).resolve().as_uri()
+                count += 1
+    return count
+
+
+def _stat_image(path: str):
+    """stat 图片并在需要时解析绝对路径；文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    uri = Path(path).resolve().as_uri() if config.websocket.image_file_uri else None
+    return st, uri
+
+
+# 分块 base64 编码的块大小，须为 3 的倍数，块之间才不会产生填充
+_B64_CHUNK = 48 * 1024
+
+
+def _read_image_b64(path: str) -> str:
+    """分块读取图片并编码为 base64 URI（在线程池中执行），避免整文件读入后的多份临时拷贝"""
+    buf = bytearray(b"base64://")
+    with open(path, "rb") as f:
+        while chunk := f.read(_B64_CHUNK):
+            buf += base64.b64encode(chunk)
+    return buf.decode("ascii")
+
+
+async def _image_segment(path: Optional[str]) -> Optional[MessageSegment]:
+    """构造图片消息段；文件不存在或读取失败时返回 None"""
+    if not path:
+        return None
+    if config.websocket.image_file_uri:
+        file_uri = _IMAGE_REGISTRY.get(path)
+        if file_uri is not None:
+            return MessageSegment.image(file_uri)
+    
+    # stat / 读文件 / 编码都放到线程池，避免阻塞驱动 WS 的事件循环
+    stat = await asyncio.to_thread(_stat_image, path)
+    if stat is None:
+        return None
+    st, file_uri = stat
+    
+    # OneBot 实现在本机时直接交给它本地路径，不必读取和编码文件
+    if file_uri is not None:
+        _IMAGE_REGISTRY[path] = file_uri
+        return MessageSegment.image(file_uri)
+    
+    key = (path, st.st_mtime_ns, st.st_size)
+    uri = _IMG_B64_CACHE.get(key)
+    if uri is not None:
+        _IMG_B64_CACHE.move_to_end(key)
+        return MessageSegment.image(uri)
+    
+    try:
+        uri = await asyncio.to_thread(_read_image_b64, path)
+    except OSError as e:
+        log("ERROR", f"读取图片失败: {e}")
+        return None
+    
+    if st.st_size <= _IMG_B64_CACHE_FILE_LIMIT:
+        _IMG_B64_CACHE[key] = uri
+        if len(_IMG_B64_CACHE) > _IMG_B64_CACHE_MAX:
+            _IMG_B64_CACHE.popitem(last=False)
+    return MessageSegment.image(uri)
+
+
+def _seg_text(data: dict, self_ids: tuple) -> tuple[str, bool]:
+    return data.get('text', ''), False
+
+
+def _seg_at(data: dict, self_ids: tuple) -> tuple[str, bool]:
+    at_qq = data.get('qq', '')
+    # 对 @机器人 使用 [@bot]，@全体成员 使用 [@all]（也响应），对其他人保留 [AT: QQ]
+    # self_ids 同时包含字符串和整数形式，qq 字段无论哪种类型都无需再转换
+    if at_qq in self_ids:
+        return '[@bot] ', True
+    if at_qq == 'all':
+        return '[@all] ', True
+    return f'[AT: {at_qq}] ', False
+
+
+def _seg_image(data: dict, self_ids: tuple) -> tuple[str, bool]:
+    # 提取图片哈希和URL，格式化为 [IMG:hash|url]；file 通常是 {hash}.image 格式
+    file_name = data.get('file', '')
+    img_hash = file_name.split('.')[0] if file_name else 'unknown'
+    return f"[IMG:{img_hash}|{data.get('url', '')}]", False
+
+
+# 消息段类型 -> 转换函数 (data, 机器人QQ (str, int)) -> (文本, 是否@了机器人)；未列出的类型忽略
+_SEG_HANDLERS: Dict[str, Callable[[dict, tuple], tuple[str, bool]]] = {
+    'text': _seg_text,
+    'at': _seg_at,
+    'image': _seg_image,
+}
+
+
+def _render_banner() -> str:
+    """启动横幅与 WebSocket 地址提示"""
+    ws_url = f"ws://{config.websocket.host}:{config.websocket.port}/"
+    return "\n".join([
+        "=" * 50,
+        "❄️  DaiyoseiBot - 拟人化群聊机器人 (琪露诺)",
+        "=" * 50,
+        "",
+        "🌐 正在启动 WebSocket 服务器...",
+        f"   地址: {ws_url}",
+        "",
+        "💡 请在 NapCat 配置中添加反向 WebSocket 地址:",
+        f"   {ws_url}",
+        "",
+        "⏳ 等待 NapCat 连接...",
+        "",
+    ])
 
 
 class DaiyoseiBot:
@@ -35,31 +266,196 @@ class DaiyoseiBot:
         self._bot = CQHttp()
         self._db: Optional[Database] = None
         self._handler: Optional[GameHandler] = None
+        # 后台进行的初始化任务（见 _bootstrap）
+        self._init_task: Optional[asyncio.Task] = None
         self._running = False
+        # 机器人 QQ 号的 (字符串, 整数) 形式，连接时确定，用于免转换比较
+        self._self_ids: tuple = ()
+        # 后续气泡的发送队列与 worker {(is_group, target_id): ...}：条目为 (deadline, index, bubble)，
+        # 每个会话一个，按入队顺序（即 deadline 顺序）发送，空闲后自动退出
+        self._bubble_queues: Dict[tuple, asyncio.Queue] = {}
+        self._bubble_workers: Dict[tuple, asyncio.Task] = {}
+        # 各会话排队中的气泡数和最后一条的发送时间 {(is_group, target_id): ...}
+        self._send_pending: Dict[tuple, int] = {}
+        self._send_tail: Dict[tuple, float] = {}
+        # Handler 发出消息的出站队列与消费任务 {(is_group, target_id): ...}，每个会话一个，空闲后自动退出
+        self._out_queues: Dict[tuple, asyncio.Queue] = {}
+        self._out_workers: Dict[tuple, asyncio.Task] = {}
+        # 各群最近一次由 Handler 发出且已写入上下文（response.in_context）的文本签名，用于快速识别自身消息回显
+        self._last_self_sig: Dict[int, int] = {}
+        # get_msg 结果缓存 {message_id: (获取时间, 消息数据)}
+        self._reply_cache: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
         
         # 注册消息处理器
         self._register_handlers()
     
-    async def _on_handler_proactive_message(self, target_id: int, response: GameResponse, is_group: bool = True):
-        """处理来自 Handler 的即时主动消息"""
+    async def _on_handler_proactive_message(self, target_id: int, response: GameResponse, is_group: bool = True,
+                                            wait: bool = False):
+        """处理来自 Handler 的即时主动消息
+
+        默认放入会话出站队列后立即返回；wait=True 时等待该条消息的全部气泡都已发出才返回，
+        任一私聊气泡发送失败的异常会抛回调用方（如非好友检测）。
+        """
+        if is_group and response.in_context and response.multi_segments:
+            # Handler 已把这段回复写入上下文，记下签名，回显时即可跳过上下文比对
+            texts = [seg.get("text", "") for seg in response.multi_segments if not seg.get("custom_action")]
+            self._last_self_sig[target_id] = hash("\n".join(t for t in texts if t.strip()).strip())
+        # 放入该会话的出站队列，由单个消费任务按顺序发送
+        key = (is_group, target_id)
+        queue = self._out_queues.get(key)
+        if queue is None:
+            queue = self._out_queues[key] = asyncio.Queue(maxsize=_OUT_QUEUE_MAX)
+            self._out_workers[key] = asyncio.create_task(self._sender_loop(key, queue))
+        fut = asyncio.get_running_loop().create_future() if wait else None
         try:
-            # 统一分发逻辑
-            await self._dispatch_response(target_id, response, is_group)
-        except Exception as e:
-            log("ERROR", f"发送即时主动消息出错: {e}")
+            queue.put_nowait((response, fut))
+        except asyncio.QueueFull:
+            log("WARN", f"出站队列已满，丢弃发往 {target_id} 的消息")
+            if fut is not None:
+                raise RuntimeError("出站队列已满")
+            return
+        if fut is not None:
+            await fut
+    
+    async def _sender_loop(self, key: tuple, queue: asyncio.Queue):
+        """单个会话的出站消费任务：依次发送队列中的响应（积压的相邻响应合并发送），空闲一段时间后退出"""
+        is_group, target_id = key
+        pending = None
+        while True:
+            if pending is not None:
+                (response, fut), pending = pending, None
+            else:
+                try:
+                    response, fut = await asyncio.wait_for(queue.get(), _OUT_WORKER_IDLE)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        self._out_queues.pop(key, None)
+                        self._out_workers.pop(key, None)
+                        return
+                    continue
+            
+            # 把已积压的后续响应并入本次发送：前一条的最后一个气泡与后一条的第一个气泡合为一条消息
+            # 需要回传发送结果的响应单独发送，不参与合并
+            size = _response_text_len(response)
+            while fut is None and not queue.empty():
+                nxt, nxt_fut = item = queue.get_nowait()
+                nxt_size = _response_text_len(nxt)
+                if (nxt_fut is not None or nxt.reply_to or size + nxt_size > _MERGE_MAX_CHARS
+                        or any(seg.get("custom_action") for seg in nxt.multi_segments)):
+                    pending = item
+                    break
+                response = _merge_responses(response, nxt)
+                size += nxt_size
+            
+            try:
+                # 统一分发逻辑；需要回传结果时整条响应在本任务内发完
+                await self._dispatch_response(target_id, response, is_group, wait=fut is not None)
+            except asyncio.CancelledError:
+                if fut is not None and not fut.done():
+                    fut.cancel()
+                raise
+            except Exception as e:
+                if fut is not None:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    log("ERROR", f"发送即时主动消息出错: {e}")
+            else:
+                if fut is not None and not fut.done():
+                    fut.set_result(None)
             
-    async def _dispatch_response(self, target_id: int, response: GameResponse, is_group: bool):
+    async def _dispatch_response(self, target_id: int, response: GameResponse, is_group: bool, raise_private: bool = True,
+                                 wait: bool = False):
         """
         统一的消息发送分发核心 (Implementation of send_message)
         
+        首条气泡在当前协程内发送；其余气泡按发送时间放入该会话的队列由后台 worker 依次发送，调用方立即返回。
+        response.staggered 为 False 时，相邻的普通气泡合并为一条消息一次发出。
+        
         Args:
            target_id: group_id or user_id
            response: GameResponse Object
            is_group: True for group message, False for private message
+           raise_private: 私聊首条气泡发送失败时是否抛出（让调用者知道失败，如好友检测）
+           wait: 先等该会话排队中的气泡发完，再在当前协程内依次发送全部气泡，返回时整条响应均已发出；
+                 此时任一私聊气泡失败都会抛出
         """
         if not hasattr(response, 'multi_segments') or not response.multi_segments:
             return
 
+        bubbles = await self._build_bubbles(target_id, response, is_group)
+        if not bubbles:
+            return
+        
+        key = (is_group, target_id)
+        if wait:
+            queue = self._bubble_queues.get(key)
+            if queue is not None:
+                await queue.join()
+            for index, bubble in enumerate(bubbles):
+                if index and bubbles[index - 1][0] == "msg":
+                    await asyncio.sleep(1.5)
+                await self._send_bubble(target_id, bubble, is_group, index + 1, True)
+            return
+        
+        if self._send_pending.get(key):
+            # 同一会话上一轮的气泡还在排队，本轮整体排在其后，保证消息顺序
+            deadline, start = self._send_tail[key], 0
+            prev_kind = "msg"
+        else:
+            await self._send_bubble(target_id, bubbles[0], is_group, 1, raise_private)
+            deadline, start = time.monotonic(), 1
+            prev_kind = bubbles[0][0]
+        
+        for index in range(start, len(bubbles)):
+            # 普通气泡之后保留 1.5 秒的气泡间隔
+            if prev_kind == "msg":
+                deadline += 1.5
+            self._enqueue_bubble(deadline, target_id, is_group, index + 1, bubbles[index])
+            prev_kind = bubbles[index][0]
+
+    def _enqueue_bubble(self, deadline: float, target_id: int, is_group: bool, index: int, bubble: tuple):
+        """把气泡放入该会话的发送队列，在 deadline (monotonic) 之后发送"""
+        key = (is_group, target_id)
+        queue = self._bubble_queues.get(key)
+        if queue is None:
+            queue = self._bubble_queues[key] = asyncio.Queue()
+            self._bubble_workers[key] = asyncio.create_task(self._bubble_worker_loop(key, queue))
+        self._send_pending[key] = self._send_pending.get(key, 0) + 1
+        self._send_tail[key] = deadline
+        queue.put_nowait((deadline, index, bubble))
+
+    async def _bubble_worker_loop(self, key: tuple, queue: asyncio.Queue):
+        """单个会话的气泡发送任务：到点后依次发送，某个会话发送缓慢不会拖慢其他会话；空闲一段时间后退出"""
+        is_group, target_id = key
+        while True:
+            try:
+                deadline, index, bubble = await asyncio.wait_for(queue.get(), _OUT_WORKER_IDLE)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self._bubble_queues.pop(key, None)
+                    self._bubble_workers.pop(key, None)
+                    return
+                continue
+            try:
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._send_bubble(target_id, bubble, is_group, index, raise_private=False)
+            except Exception as e:
+                log("ERROR", f"后续气泡发送失败: {e}")
+            finally:
+                remaining = self._send_pending.get(key, 1) - 1
+                if remaining > 0:
+                    self._send_pending[key] = remaining
+                else:
+                    self._send_pending.pop(key, None)
+                    self._send_tail.pop(key, None)
+                queue.task_done()
+
+    async def _build_bubbles(self, target_id: int, response: GameResponse, is_group: bool) -> list:
+        """把 multi_segments 转换为待发送的气泡列表 [("action", (action, params)) | ("msg", msg_chain)]"""
+        bubbles = []
         for i, segment in enumerate(response.multi_segments):
             text = segment.get("text", "")
             image_path = segment.get("image_path")
@@ -76,14 +472,17 @@ class DaiyoseiBot:
                             params["group_id"] = target_id
                         elif not is_group and "user_id" not in params:
                             params["user_id"] = target_id
-                        
-                        log("DEBUG", f"执行自定义动作: {action}, target: {target_id}")
-                        await self._bot.call_action(action, **params)
+                        bubbles.append(("action", (action, params)))
                 except Exception as e:
                     log("ERROR", f"执行自定义动作失败: {e}")
                 continue
 
-            # 2. 普通消息转换与构建
+            # 2. 先检查实质内容（即使有 reply_to，没有文字或图片也跳过），再构建消息链
+            has_text = bool(text and text.strip())
+            image_seg = await _image_segment(image_path)
+            if not has_text and image_seg is None:
+                continue
+            
             msg_chain = []
             
             # 这里的 reply_to 主要是针对这轮对话的首次回复
@@ -92,43 +491,47 @@ class DaiyoseiBot:
                 msg_chain.append(MessageSegment.reply(response.reply_to))
                 
             # 添加图片
-            if image_path and os.path.exists(image_path):
-                try:
-                    with open(image_path, "rb") as f:
-                        image_data = base64.b64encode(f.read()).decode()
-                    msg_chain.append(MessageSegment.image(f"base64://{image_data}"))
-                except Exception as e:
-                    log("ERROR", f"读取图片失败: {e}")
+            if image_seg is not None:
+                msg_chain.append(image_seg)
             
             # 添加文本 (OneBot v11 JSON 数组格式转换)
-            if text:
-                parsed_text_segments = self._build_message_segments(text)
-                msg_chain.extend(parsed_text_segments)
+            if has_text:
+                msg_chain.extend(self._build_message_segments(text))
             
-            # 检查实质内容
-            has_substance = bool(image_path and os.path.exists(image_path)) or bool(text and text.strip())
-            if not has_substance:
-                continue
-                
-            # 3. 底层发送 (_dispatch_send equivalent)
+            # 不需要逐条气泡效果（或该段标记了 bubble_join）时，与前一条普通气泡合并
+            join = not response.staggered or segment.get("bubble_join")
+            if join and bubbles and bubbles[-1][0] == "msg":
+                bubbles[-1][1].append(MessageSegment.text("\n"))
+                bubbles[-1][1].extend(msg_chain)
+            else:
+                bubbles.append(("msg", msg_chain))
+        return bubbles
+
+    async def _send_bubble(self, target_id: int, bubble: tuple, is_group: bool, index: int, raise_private: bool):
+        """发送单个气泡 (_dispatch_send equivalent)"""
+        kind, payload = bubble
+        if kind == "action":
+            action, params = payload
             try:
-                if is_group:
-                    log("INFO", f"Sending group msg to {target_id} (segment {i+1})...")
-                    await self._bot.send_group_msg(group_id=target_id, message=msg_chain)
-                else:
-                    log("INFO", f"Sending private msg to {target_id} (segment {i+1})...")
-                    await self._bot.send_private_msg(user_id=target_id, message=msg_chain)
+                log("DEBUG", f"执行自定义动作: {action}, target: {target_id}")
+                await self._bot.call_action(action, **params)
             except Exception as e:
-                log("ERROR", f"发送消息气泡失败: {e}")
-                # 私聊发送失败时重新抛出，以便调用者知道失败（如好友检测）
-                if not is_group:
-                    raise
-            
-            # 气泡延迟
-            if i < len(response.multi_segments) - 1:
-                await asyncio.sleep(1.5)
+                log("ERROR", f"执行自定义动作失败: {e}")
+            return
+        
+        try:
+            if is_group:
+                log("INFO", f"Sending group msg to {target_id} (segment {index})...")
+                await self._bot.send_group_msg(group_id=target_id, message=payload)
+            else:
+                log("INFO", f"Sending private msg to {target_id} (segment {index})...")
+                await self._bot.send_private_msg(user_id=target_id, message=payload)
+        except Exception as e:
+            log("ERROR", f"发送消息气泡失败: {e}")
+            # 私聊发送失败时重新抛出，以便调用者知道失败（如好友检测）
+            if not is_group and raise_private:
+                raise
 
-            
     def _register_handlers(self):
         """注册消息处理器"""
         
@@ -136,30 +539,41 @@ class DaiyoseiBot:
         @self._bot.on('message')
         async def handle_all_messages(event: Event):
             """处理所有消息事件"""
-            log("DEBUG", f">>> 收到消息事件: {event.post_type}")
-            log("DEBUG", f"    消息类型: {getattr(event, 'message_type', 'unknown')}")
-            log("DEBUG", f"    用户ID: {getattr(event, 'user_id', 'unknown')}")
-            log("DEBUG", f"    群ID: {getattr(event, 'group_id', 'unknown')}")
-            log("DEBUG", f"    原始消息: {getattr(event, 'message', 'unknown')}")
-            log("DEBUG", f"    Raw message type: {type(event.message)}")
+            msg_type = getattr(event, 'message_type', None)
+            user_id = getattr(event, 'user_id', None)
+            group_id = getattr(event, 'group_id', 0)
             
-            # 打印完整事件数据用于调试
-            try:
-                event_dict = {k: v for k, v in event.__dict__.items() if not k.startswith('_')}
-                log("DEBUG", f"    完整事件: {json.dumps(event_dict, ensure_ascii=False, default=str)[:500]}")
-            except Exception as e:
-                log("DEBUG", f"    无法序列化事件: {e}")
+            if _DEBUG:
+                message = getattr(event, 'message', 'unknown')
+                log("DEBUG", f">>> 收到消息事件: {event.post_type}")
+                log("DEBUG", f"    消息类型: {msg_type or 'unknown'}")
+                log("DEBUG", f"    用户ID: {user_id or 'unknown'}")
+                log("DEBUG", f"    群ID: {group_id or 'unknown'}")
+                log("DEBUG", f"    原始消息: {message}")
+                log("DEBUG", f"    Raw message type: {type(message)}")
+                
+                # 打印完整事件数据用于调试
+                try:
+                    event_dict = {k: v for k, v in event.__dict__.items() if not k.startswith('_')}
+                    if orjson is not None:
+                        dumped = orjson.dumps(event_dict, default=str)[:500].decode("utf-8", errors="ignore")
+                    else:
+                        dumped = json.dumps(event_dict, ensure_ascii=False, default=str)[:500]
+                    log("DEBUG", f"    完整事件: {dumped}")
+                except Exception as e:
+                    log("DEBUG", f"    无法序列化事件: {e}")
+            
+            if not await self._ensure_ready():
+                log("WARN", "聊天引擎未就绪，忽略消息")
+                return
             
             # Blacklist interception layer
-            user_id = getattr(event, 'user_id', None)
-            group_id = getattr(event, 'group_id', 0)
             if user_id and self._db:
                 if await self._db.is_blacklisted(user_id, group_id):
                     log("INFO", f"🚫 [Blacklist] 拦截黑名单用户消息: User={user_id}, Group={group_id}")
                     return
             
             # 根据消息类型分发处理
-            msg_type = getattr(event, 'message_type', None)
             if msg_type == 'group':
                 await self._process_group_message(event)
             elif msg_type == 'private':
@@ -176,11 +590,14 @@ class DaiyoseiBot:
                     # 尝试获取机器人 QQ 号
                     self_id = getattr(event, 'self_id', None)
                     if self_id:
-                        self._bot.self_id = self_id
-                        if self._handler:
-                            self._handler.self_id = int(self_id)
+                        self._set_self_id(self_id)
                         log("INFO", f"机器人 QQ: {self_id}")
-                    print(f"✅ OneBot 客户端已连接")
+                    logger.info("✅ OneBot 客户端已连接")
+                    
+                    # 后台任务依赖数据库和已恢复的记忆，等待初始化完成
+                    if not await self._ensure_ready():
+                        log("ERROR", "聊天引擎未就绪，跳过后台任务启动")
+                        return
                     
                     # 关键修复：在正确的事件循环中启动后台任务
                     if self._handler:
@@ -189,15 +606,20 @@ class DaiyoseiBot:
                     # 启动任务队列
                     from ..utils.task_queue import task_queue
                     await task_queue.start()
+                    
+                    # 预先登记表情包目录，发送时直接引用本地路径
+                    if config.websocket.image_file_uri and not _IMAGE_REGISTRY:
+                        count = await asyncio.to_thread(_register_images, _MEME_DIR)
+                        log("INFO", f"已登记 {count} 张本地表情包")
             # 心跳事件也会带有 self_id
             elif event.meta_event_type == "heartbeat":
                 self_id = getattr(event, 'self_id', None)
                 if self_id and not hasattr(self._bot, 'self_id'):
-                    self._bot.self_id = self_id
+                    self._set_self_id(self_id)
                     log("INFO", f"从心跳获取机器人 QQ: {self_id}")
                 
                 # 检查是否有待发送的主动消息
-                if self._handler:
+                if self._handler and self._handler.ready.is_set():
                     await self._check_proactive_messages()
         
         @self._bot.on_notice
@@ -212,11 +634,44 @@ class DaiyoseiBot:
             
             if request_type == 'friend':
                 # 好友添加请求
-                await self._handle_friend_request(event)
+                if await self._ensure_ready():
+                    await self._handle_friend_request(event)
             elif request_type == 'group':
                 # 群邀请或加群请求
                 log("INFO", f"收到群请求: {getattr(event, 'sub_type', 'unknown')}")
     
+    async def _get_msg_cached(self, message_id) -> Optional[dict]:
+        """带 TTL 的 get_msg，避免同一条被引用消息重复走一次 WS 往返"""
+        message_id = int(message_id)
+        now = time.monotonic()
+        hit = self._reply_cache.get(message_id)
+        if hit is not None and now - hit[0] < _REPLY_CACHE_TTL:
+            self._reply_cache.move_to_end(message_id)
+            return hit[1]
+        
+        data = await self._bot.get_msg(message_id=message_id)
+        if data:
+            self._reply_cache[message_id] = (now, data)
+            self._reply_cache.move_to_end(message_id)
+            if len(self._reply_cache) > _REPLY_CACHE_MAX:
+                self._reply_cache.popitem(last=False)
+        return data
+    
+    def _set_self_id(self, self_id):
+        """记录机器人 QQ 号，并预先算好比较用的字符串/整数形式"""
+        self._bot.self_id = self_id
+        self._self_ids = (str(self_id), int(self_id))
+        if self._handler:
+            self._handler.self_id = int(self_id)
+    
+    def _current_self_ids(self) -> tuple:
+        """机器人 QQ 号的 (str, int) 形式；尚未知晓时为空元组"""
+        if not self._self_ids:
+            self_id = getattr(self._bot, 'self_id', None)
+            if self_id:
+                self._set_self_id(self_id)
+        return self._self_ids
+    
     def _extract_text_from_message(self, message) -> tuple[str, bool, int]:
         """
         从 OneBot 消息中提取纯文本内容
@@ -227,77 +682,84 @@ class DaiyoseiBot:
         Returns:
             (纯文本内容, 是否@了机器人, 机器人QQ号)
         """
-        text_parts = []
-        at_self = False
         self_id = getattr(self._bot, 'self_id', None)
-        
-        # 如果是 list (array 格式)
         if isinstance(message, list):
-            for seg in message:
-                if isinstance(seg, dict):
-                    seg_type = seg.get('type', '')
-                    seg_data = seg.get('data', {})
-                    
-                    if seg_type == 'text':
-                        text_parts.append(seg_data.get('text', ''))
-                    elif seg_type == 'at':
-                        at_qq = seg_data.get('qq', '')
-                        # 检查是否 @ 了机器人，是则标记 at_self
-                        if self_id and str(at_qq) == str(self_id):
-                            at_self = True
-                            # 即使是 @机器人，也保留标准格式 [AT: QQ] 吗？
-                            # 为了让 LLM 清楚知道是艾特自己，可以使用 [@bot] 或 [AT: self_id]
-                            # 这里我们保留两者语义：[@bot] 用于强调，[AT: QQ] 用于统一
-                            # 简化起见，对 @机器人 使用 [@bot]，对其他人使用 [AT: QQ]
-                            text_parts.append('[@bot] ')
-                        elif at_qq == 'all':
-                            at_self = True  # @全体成员也响应
-                            text_parts.append('[@all] ')
-                        else:
-                            # 保留艾特其他人的信息！这是之前漏掉的
-                            text_parts.append(f'[AT: {at_qq}] ')
-                            
-                    elif seg_type == 'image':
-                        # 提取图片哈希和URL，格式化为 [IMG:hash|url]
-                        # file 通常是 {hash}.image 格式
-                        file_name = seg_data.get('file', '')
-                        url = seg_data.get('url', '')
-                        img_hash = file_name.split('.')[0] if file_name else 'unknown'
-                        text_parts.append(f'[IMG:{img_hash}|{url}]')
-                else:
-                    # aiocqhttp 的 MessageSegment 对象
-                    if hasattr(seg, 'type') and hasattr(seg, 'data'):
-                        if seg.type == 'text':
-                            text_parts.append(seg.data.get('text', ''))
-                        elif seg.type == 'at':
-                            at_qq = seg.data.get('qq', '')
-                            if self_id and str(at_qq) == str(self_id):
-                                at_self = True
-                                text_parts.append('[@bot] ')
-                            else:
-                                text_parts.append(f'[AT: {at_qq}] ')
-                        elif seg.type == 'image':
-                            file_name = seg.data.get('file', '')
-                            url = seg.data.get('url', '')
-                            img_hash = file_name.split('.')[0] if file_name else 'unknown'
-                            text_parts.append(f'[IMG:{img_hash}|{url}]')
+            text, at_self = self._extract_from_list(message, self._current_self_ids())
         else:
-            # 字符串格式 (CQ码)
-            text_parts.append(str(message))
-            # 简单检测 CQ:at
-            if self_id and f'[CQ:at,qq={self_id}]' in str(message):
-                at_self = True
-                # 在字符串开头添加 [@bot] 标记可能不准确，但也只能这样
-                # 更理想的是正则替换，但这里先简单处理
-                if '[@bot]' not in str(message): 
-                     text_parts.insert(0, '[@bot] ')
-        
-        return ''.join(text_parts).strip(), at_self, self_id
+            text, at_self = self._extract_from_str(message, self_id)
+        return text, at_self, self_id
+    
+    @staticmethod
+    def _extract_from_list(message: list, self_ids: tuple) -> tuple[str, bool]:
+        """array 格式消息：逐段转换为文本"""
+        # 常见情况：只有一个文本段，直接返回
+        if len(message) == 1:
+            seg = message[0]
+            if isinstance(seg, dict) and seg.get('type') == 'text':
+                return seg.get('data', {}).get('text', '').strip(), False
+        
+        text_parts = []
+        at_self = False
+        
+        for seg in message:
+            # dict 段与 aiocqhttp 的 MessageSegment 对象统一取 type / data
+            if isinstance(seg, dict):
+                seg_type = seg.get('type', '')
+                seg_data = seg.get('data', {})
+            elif hasattr(seg, 'type') and hasattr(seg, 'data'):
+                seg_type = seg.type
+                seg_data = seg.data
+            else:
+                continue
+            
+            handler = _SEG_HANDLERS.get(seg_type)
+            if handler is not None:
+                text, mentions_self = handler(seg_data, self_ids)
+                text_parts.append(text)
+                at_self |= mentions_self
+        
+        return ''.join(text_parts).strip(), at_self
+    
+    @staticmethod
+    def _extract_from_str(message, self_id) -> tuple[str, bool]:
+        """字符串格式 (CQ码)"""
+        text = message if isinstance(message, str) else str(message)
+        # 不含 CQ:at 时无需进一步检测
+        if '[CQ:at' not in text:
+            return text.strip(), False
+        # 简单检测 CQ:at
+        if self_id and f'[CQ:at,qq={self_id}]' in text:
+            # 在字符串开头添加 [@bot] 标记可能不准确，但也只能这样
+            if '[@bot]' not in text:
+                text = '[@bot] ' + text
+            return text.strip(), True
+        return text.strip(), False
     
     async def _process_group_message(self, event: Event):
         """处理群消息"""
         user_id = event.user_id
         group_id = event.group_id
+        self_ids = self._current_self_ids()
+        
+        # 检查是否是回复消息 (检查消息段中的 reply 类型)
+        reply_id = None
+        if isinstance(event.message, list):
+            for seg in event.message:
+                if isinstance(seg, dict) and seg.get('type') == 'reply':
+                    reply_id = seg.get('data', {}).get('id')
+                    break
+                elif hasattr(seg, 'type') and seg.type == 'reply':
+                    reply_id = seg.data.get('id')
+                    break
+        
+        # 也可以检查 event.reply (NapCat/Go-CQHTTP 扩展字段)
+        if not reply_id and getattr(event, 'reply', None):
+            reply_id = event.reply.get('message_id')
+        
+        # 尽早发起被引用消息的拉取，与下面的文本解析等本地处理重叠
+        reply_task = None
+        if reply_id and user_id not in self_ids:
+            reply_task = asyncio.create_task(self._get_msg_cached(reply_id))
         
         # 正确解析消息内容
         text_content, at_self, self_id = self._extract_text_from_message(event.message)
@@ -307,16 +769,23 @@ class DaiyoseiBot:
         log("INFO", f"提取的文本: '{text_content}'")
         
         # 0. 如果是机器人自己的消息，只添加到上下文，不触发处理
-        if self_id and str(user_id) == str(self_id):
+        if user_id in self_ids:
             log("DEBUG", "检测到自身发送的消息，检查是否需要添加到上下文")
             if self._handler:
+                # 快速路径：与 Handler 刚发出的文本签名一致，说明已在上下文中
+                sig = hash(text_content.strip())
+                if self._last_self_sig.get(group_id) == sig:
+                    del self._last_self_sig[group_id]
+                    log("DEBUG", "检测到重复的自身消息（签名命中），跳过添加")
+                    return
+                
                 # 检查最后一条消息是否相同，避免重复（因为 process_message 可能已经加过了）
                 last_msgs = self._handler._get_context(group_id, limit=1)
                 should_add = True
                 if last_msgs:
                     last_msg = last_msgs[-1]
                     # 检查发送者是否是自己，且内容是否极其相似（去空格后）
-                    if (str(last_msg.get('sender_id')) == str(self_id) and 
+                    if (last_msg.get('sender_id') in self_ids and 
                         last_msg.get('content', '').strip() == text_content.strip()):
                         should_add = False
                         log("DEBUG", "检测到重复的自身消息（已在上下文中），跳过添加")
@@ -332,30 +801,15 @@ class DaiyoseiBot:
                     )
             return
         
-        # 检查是否是回复消息 (检查消息段中的 reply 类型)
-        reply_id = None
-        if isinstance(event.message, list):
-            for seg in event.message:
-                if isinstance(seg, dict) and seg.get('type') == 'reply':
-                    reply_id = seg.get('data', {}).get('id')
-                    break
-                elif hasattr(seg, 'type') and seg.type == 'reply':
-                    reply_id = seg.data.get('id')
-                    break
-        
-        # 也可以检查 event.reply (NapCat/Go-CQHTTP 扩展字段)
-        if not reply_id and getattr(event, 'reply', None):
-            reply_id = event.reply.get('message_id')
-
         is_reply_to_me = False
         reply_content_text = ""
         reply_sender_nickname = ""
         
-        if reply_id:
+        if reply_task is not None:
             try:
                 log("DEBUG", f"检测到回复消息 struct, ID: {reply_id}, 正在拉取原始内容...")
-                # 调用 get_msg 获取被回复的消息详情
-                reply_msg_data = await self._bot.get_msg(message_id=int(reply_id))
+                # 等待 get_msg 获取被回复的消息详情
+                reply_msg_data = await reply_task
                 
                 if reply_msg_data:
                     # 提取发送者信息
@@ -364,7 +818,7 @@ class DaiyoseiBot:
                     reply_sender_nickname = r_sender.get('nickname', '未知')
                     
                     # 检查是否回复的机器人
-                    if self_id and str(reply_sender_id) == str(self_id):
+                    if reply_sender_id in self_ids:
                         is_reply_to_me = True
                         log("DEBUG", "检测到回复机器人的消息")
                     
@@ -387,7 +841,7 @@ class DaiyoseiBot:
                 # Fallback: 尝试使用 event.reply 如果存在
                 if getattr(event, 'reply', None):
                     r_sender_id = event.reply.get('sender', {}).get('user_id')
-                    if self_id and str(r_sender_id) == str(self_id):
+                    if r_sender_id in self_ids:
                         is_reply_to_me = True
                     # 尝试提取文本（可能不完整）
                     reply_content_text = str(event.reply.get('message', ''))
@@ -424,9 +878,6 @@ class DaiyoseiBot:
             log("ERROR", "Handler 未初始化!")
             return
         
-        if self_id and self._handler:
-            self._handler.self_id = int(self_id)
-            
         try:
             log("DEBUG", "调用 handler.process_message...")
             response = await self._handler.process_message(
@@ -460,10 +911,6 @@ class DaiyoseiBot:
         log("INFO", f"用户: {user_id}")
         log("INFO", f"提取的文本: '{text_content}'")
         
-        # 2. 对话处理
-        return await self._handler.handle_private_message(user_id, text_content)
-
-        
         # 私聊使用 user_id 作为 session_id
         session_id = user_id
         
@@ -558,13 +1005,7 @@ class DaiyoseiBot:
                 async def send_welcome():
                     await asyncio.sleep(2)
                     try:
-                        welcome_msgs = [
-                            "嘿嘿，你好呀~ 我是琪露诺，最强的冰精灵！有什么想聊的吗？",
-                            "哇！是新朋友！你好你好~ 我是⑨哦~",
-                            "欢迎欢迎！以后有什么事可以找我聊天哦~"
-                        ]
-                        import random
-                        await self._bot.send_private_msg(user_id=user_id, message=random.choice(welcome_msgs))
+                        await self._bot.send_private_msg(user_id=user_id, message=random.choice(_WELCOME_MSGS))
                     except Exception as e:
                         log("WARNING", f"发送欢迎消息失败: {e}")
                 
@@ -594,103 +1035,47 @@ class DaiyoseiBot:
         # 复制一份待处理列表
         pending_groups = list(self._handler._pending_proactive_messages.keys())
         
+        pending = []
         for group_id in pending_groups:
             data = self._handler.get_proactive_message(group_id)
-            if not data:
-                continue
+            if data:
+                pending.append((group_id, data.get("text", ""), data.get("meme_path")))
+        if not pending:
+            return
+        
+        # 同一张表情包只读取/编码一次
+        meme_paths = list({meme_path for _, _, meme_path in pending if meme_path})
+        meme_segs = dict(zip(meme_paths, await asyncio.gather(*(_image_segment(p) for p in meme_paths))))
+        
+        to_send = []
+        for group_id, text, meme_path in pending:
+            log("INFO", f"[ProactiveChat] 向群 {group_id} 发送主动消息: {text[:30]}...")
             
-            text = data.get("text", "")
-            meme_path = data.get("meme_path")
+            # 构造消息段
+            msg_segments = []
+            meme_seg = meme_segs.get(meme_path)
+            if meme_seg is not None:
+                msg_segments.append(meme_seg)
+                if text:
+                    msg_segments.append(MessageSegment.text(f"\n{text}"))
+            elif text:
+                msg_segments.append(MessageSegment.text(text))
             
-            try:
-                log("INFO", f"[ProactiveChat] 向群 {group_id} 发送主动消息: {text[:30]}...")
-                
-                # 构造消息段
-                msg_segments = []
-                if meme_path and os.path.exists(meme_path):
-                    with open(meme_path, "rb") as f:
-                        image_data = base64.b64encode(f.read()).decode()
-                    msg_segments.append(MessageSegment.image(f"base64://{image_data}"))
-                    if text:
-                        msg_segments.append(MessageSegment.text(f"\n{text}"))
-                elif text:
-                    msg_segments.append(MessageSegment.text(text))
-                
-                if msg_segments:
-                    await self._bot.send_group_msg(
-                        group_id=group_id,
-                        message=msg_segments
-                    )
-            except Exception as e:
-                log("ERROR", f"发送主动消息失败: {e}")
+            if msg_segments:
+                to_send.append((group_id, msg_segments))
+        
+        # 各群的发送一起提交，不再逐个等待
+        results = await asyncio.gather(
+            *(self._bot.send_group_msg(group_id=group_id, message=chain) for group_id, chain in to_send),
+            return_exceptions=True
+        )
+        for (group_id, _), result in zip(to_send, results):
+            if isinstance(result, Exception):
+                log("ERROR", f"发送主动消息失败 (群 {group_id}): {result}")
     
     async def _send_response(self, event: Event, response: GameResponse, is_group: bool):
-        """发送响应 - 真正的分条发送"""
-        if not hasattr(response, 'multi_segments') or not response.multi_segments:
-            return
-
-        for i, segment in enumerate(response.multi_segments):
-            text = segment.get("text", "")
-            image_path = segment.get("image_path")
-            custom_action = segment.get("custom_action")
-            
-            # 如果存在自定义动作（例如合并转发）
-            if custom_action:
-                try:
-                    action = custom_action.get("action")
-                    params = custom_action.get("params", {})
-                    if action:
-                        # 补充 group_id 或 user_id 如果缺失
-                        if is_group and "group_id" not in params:
-                            params["group_id"] = event.group_id
-                        elif not is_group and "user_id" not in params:
-                            params["user_id"] = event.user_id
-                        
-                        await self._bot.call_action(action, **params)
-                except Exception as e:
-                    log("ERROR", f"执行自定义动作失败: {e}")
-                continue
-
-            # 构造消息段列表
-            msg_chain = []
-            
-            # 如果是第一条消息且有回复目标
-            if i == 0 and response.reply_to:
-                msg_chain.append(MessageSegment.reply(response.reply_to))
-                
-            # 添加图片（如果存在）
-            if image_path and os.path.exists(image_path):
-                try:
-                    with open(image_path, "rb") as f:
-                        image_data = base64.b64encode(f.read()).decode()
-                    msg_chain.append(MessageSegment.image(f"base64://{image_data}"))
-                except Exception as e:
-                    log("ERROR", f"读取图片失败: {e}")
-            
-            # 添加文本并解析 [AT: QQ]
-            if text:
-                parsed_text_segments = self._build_message_segments(text)
-                msg_chain.extend(parsed_text_segments)
-            
-            # 检查是否有实质性内容（文字或图片）
-            has_substance = bool(image_path and os.path.exists(image_path)) or bool(text and text.strip())
-            
-            # 如果没有任何实质内容，跳过该气泡（即使它有 reply_to）
-            if not has_substance:
-                continue
-                
-            # 发送当前气泡
-            try:
-                if is_group:
-                    await self._bot.send_group_msg(group_id=event.group_id, message=msg_chain)
-                else:
-                    await self._bot.send_private_msg(user_id=event.user_id, message=msg_chain)
-            except Exception as e:
-                log("ERROR", f"发送消息气泡失败: {e}")
-            
-            # 气泡之间的硬性延迟 1.5 秒
-            if i < len(response.multi_segments) - 1:
-                await asyncio.sleep(1.5)
+        """发送响应 - 按事件来源转交 _dispatch_response（私聊失败不向上抛出）"""
+        return await self._dispatch_response(event.group_id if is_group else event.user_id, response, is_group, raise_private=False)
 
     def _build_message_segments(self, text: str) -> list:
         """解析文本中的 [AT: QQ] 标签并构造消息段列表
@@ -699,39 +1084,26 @@ class DaiyoseiBot:
         1. 支持容错匹配常见格式错误（[AT:123]、[AT 123]等）
         2. 过滤掉看起来像用户消息元数据的错误AT（如 花山由(QQ:123)[owner]: ）
         """
-        import re
-        
-        # 第一步：预处理文本，修正一些常见格式错误
-        # 1. [AT:123] -> [AT: 123]（缺少空格）
-        text = re.sub(r'\[AT:(\d+)\]', r'[AT: \1]', text)
-        # 2. [AT 123] -> [AT: 123]（缺少冒号）
-        text = re.sub(r'\[AT\s+(\d+)\]', r'[AT: \1]', text)
-        # 3. [at: 123] -> [AT: 123]（大小写）
-        text = re.sub(r'\[at:\s*(\d+)\]', r'[AT: \1]', text, flags=re.IGNORECASE)
-        
-        # 第二步：过滤掉看起来像用户消息元数据的内容
+        # 单次扫描：_AT_RE 直接兼容常见格式错误，不再先逐条改写文本
+        # 过滤掉看起来像用户消息元数据的内容
         # 例如 "花山由(QQ:2827087188)[owner]: 你好" 不应该被当作AT指令
-        # 先检测并移除这种格式的 AT 误匹配
-        # 匹配 "姓名(QQ:ID)[角色]: " 这种格式（用户消息元数据）
-        metadata_pattern = r'([^\[\]]+)\(QQ:(\d+)\)\[(owner|admin|member)\]:\s*'
-        # 不要将这种格式中的 QQ 号当作 AT
+        # 一次扫描记下每个 QQ 号在 "(QQ:ID)[" 形式中最早出现的结束位置
+        metadata_end = {}
+        for meta in _METADATA_QQ_RE.finditer(text):
+            metadata_end.setdefault(meta.group(1), meta.end())
         
         segments = []
-        pattern = r'\[AT:\s*(\d+)\]'
         last_pos = 0
         
-        for match in re.finditer(pattern, text):
+        for match in _AT_RE.finditer(text):
             qq_number = match.group(1)
             
             # 检查这个 AT 标签是否在用户元数据格式中（误识别）
-            # 查看匹配位置之前的文本，看是否包含 "(QQ:" 模式
-            before_text = text[max(0, match.start()-50):match.start()]
-            
-            # 如果在元数据格式中，跳过这个匹配
             # 元数据格式应该是 "姓名(QQ:ID)[角色]: " 形式
             # AT格式应该是独立的 "[AT: ID]"
-            # 简单检测：如果前面有 (QQ: 且后面紧跟 )[...]，说明是元数据
-            if re.search(r'\(QQ:' + re.escape(qq_number) + r'\)\[', text[:match.end()+10]):
+            # 简单检测：如果该 AT 之前（含其后 10 个字符内）出现过 (QQ:ID)[，说明是元数据
+            meta_end = metadata_end.get(qq_number)
+            if meta_end is not None and meta_end <= match.end() + 10:
                 # 这可能是元数据，不是AT，跳过
                 continue
             
@@ -750,103 +1122,105 @@ class DaiyoseiBot:
     
     async def start(self):
         """启动机器人"""
-        print("=" * 50)
-        print("❄️  DaiyoseiBot - 拟人化群聊机器人 (琪露诺)")
-        print("=" * 50)
+        # 启动信息一次性写出
+        sys.stdout.write(_render_banner())
+        sys.stdout.flush()
         
-        # 初始化数据库
-        print("📦 正在初始化数据库...")
-        self._db = Database(config.database.db_path)
-        await self._db.connect()
-        print("✅ 数据库初始化完成")
-        
-        # 初始化聊天处理器
-        print("💭 正在初始化聊天引擎...")
-        self._handler = GameHandler(self._db)
-        # 设置即时发送回调
-        self._handler.set_sender_callback(self._on_handler_proactive_message)
-        await self._handler.init()
-        print("✅ 聊天引擎初始化完成")
-        
-        # 启动 WebSocket 服务器
-        print(f"\n🌐 正在启动 WebSocket 服务器...")
-        print(f"   地址: ws://{config.websocket.host}:{config.websocket.port}/")
-        print(f"\n💡 请在 NapCat 配置中添加反向 WebSocket 地址:")
-        print(f"   ws://{config.websocket.host}:{config.websocket.port}/")
-        print("\n⏳ 等待 NapCat 连接...")
+        await self._bootstrap()
         
         self._running = True
         
-        # 运行 bot
-        self._bot.run(
+        # 在当前事件循环中运行 WebSocket 服务器：初始化时建立的连接和任务与服务器共用同一个循环
+        await self._bot.run_task(
             host=config.websocket.host,
             port=config.websocket.port
         )
     
+    async def _bootstrap(self):
+        """
+        初始化数据库和聊天处理器（重复调用时直接返回）
+        
+        初始化在后台进行，WebSocket 服务器无需等待即可接受 NapCat 连接；
+        事件处理通过 _ensure_ready 等待初始化完成。
+        """
+        if self._db is not None:
+            return
+        
+        # 数据库连接与聊天处理器中不依赖数据库的初始化并行进行
+        logger.info("📦 正在后台初始化数据库与聊天引擎...")
+        self._db = Database(config.database.db_path)
+        self._handler = GameHandler(self._db)
+        # 设置即时发送回调
+        self._handler.set_sender_callback(self._on_handler_proactive_message)
+        self._init_task = asyncio.create_task(self._handler.init(db_ready=self._db.connect()))
+        self._init_task.add_done_callback(self._on_init_done)
+    
+    def _on_init_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            logger.error(f"初始化失败: {e}", exc_info=e)
+        else:
+            logger.info("✅ 数据库与聊天引擎初始化完成")
+    
+    async def _ensure_ready(self) -> bool:
+        """等待后台初始化完成；初始化失败或未初始化时返回 False"""
+        if self._handler is not None and self._handler.ready.is_set():
+            return True
+        if self._init_task is None:
+            return False
+        try:
+            # shield：单个事件处理被取消时不影响初始化本身
+            await asyncio.shield(self._init_task)
+        except Exception:
+            return False
+        return self._handler.ready.is_set()
+    
     async def stop(self):
         """停止机器人"""
         self._running = False
         
+        # 取消尚未完成的初始化
+        if self._init_task is not None and not self._init_task.done():
+            self._init_task.cancel()
+        
+        # 停止出站队列与气泡发送队列
+        for worker in self._out_workers.values():
+            worker.cancel()
+        self._out_workers.clear()
+        self._out_queues.clear()
+        for worker in self._bubble_workers.values():
+            worker.cancel()
+        self._bubble_workers.clear()
+        self._bubble_queues.clear()
+        
+        # 关闭 LLM 客户端连接池
+        await llm_service.aclose()
+        
         # 关闭数据库
         if self._db:
-            print("📦 正在关闭数据库连接...")
+            logger.info("📦 正在关闭数据库连接...")
             await self._db.close()
             
-        print("👋 机器人已停止")
+        logger.info("👋 机器人已停止")
 
 
 def run_bot():
     """启动机器人（同步入口）"""
+    _configure_logging()
     bot = DaiyoseiBot()
     
+    async def main():
+        try:
+            await bot.start()
+        finally:
+            # 与初始化在同一个事件循环中清理（Ctrl+C 时 asyncio.run 会先取消 main）
+            await bot.stop()
+    
     try:
-        # aiocqhttp.CQHttp.run() 内部会处理事件循环
-        # 我们需要先初始化数据库
-        async def init_and_run():
-            print("=" * 50)
-            print("❄️  DaiyoseiBot - 拟人化群聊机器人 (琪露诺)")
-            print("=" * 50)
-            
-            # 初始化数据库
-            print("📦 正在初始化数据库...")
-            bot._db = Database(config.database.db_path)
-            await bot._db.connect()
-            print("✅ 数据库初始化完成")
-            
-            # 初始化聊天处理器
-            print("💭 正在初始化聊天引擎...")
-            bot._handler = GameHandler(bot._db)
-            await bot._handler.init()
-            print("✅ 聊天引擎初始化完成")
-        
-        # 运行初始化
-        loop = asyncio.get_event_loop()
-        # 这里我们在 run 之前确保 init 里的任务都进入了 loop
-        loop.run_until_complete(init_and_run())
-        
-        # 再次确保 handler 的回调已经设置（虽然 init_and_run 里已经做了）
-        if bot._handler:
-            bot._handler.set_sender_callback(bot._on_handler_proactive_message)
-        
-        # 启动 WebSocket 服务器
-        print(f"\n🌐 正在启动 WebSocket 服务器...")
-        print(f"   地址: ws://{config.websocket.host}:{config.websocket.port}/")
-        print(f"\n💡 请在 NapCat 配置中添加反向 WebSocket 地址:")
-        print(f"   ws://{config.websocket.host}:{config.websocket.port}/")
-        print("\n⏳ 等待 NapCat 连接...\n")
-        
-        bot._bot.run(
-            host=config.websocket.host,
-            port=config.websocket.port
-        )
-        
+        asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n👋 收到停止信号，正在停止机器人...")
-        # 运行清理逻辑
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(bot.stop())
-        
+        logger.info("👋 收到停止信号，机器人已停止")
     except Exception as e:
-        print(f"❌ 启动失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"❌ 启动失败: {e}", exc_info=True)
@@ -890,6 +890,8 @@ async def cmd_disable_llm(args: str, user_id: int, group_id: int, context: Dict)
     
     # 关闭大模型
     await db.disable_llm(group_id, user_id)
+    from ..ai.llm_service import llm_service
+    llm_service.invalidate_enabled(group_id)
     return CommandResult(
         success=True, 
         response=f"🔇 已关闭本群的大模型回复功能。\n\n我仍然会处理 $$ 开头的命令，但不会主动聊天啦~\n\n💡 使用 $$开启大模型 可以重新开启"
@@ -920,6 +922,8 @@ async def cmd_enable_llm(args: str, user_id: int, group_id: int, context: Dict)
     
     # 开启大模型
     await db.enable_llm(group_id)
+    from ..ai.llm_service import llm_service
+    llm_service.invalidate_enabled(group_id)
     return CommandResult(
         success=True, 
         response=f"✅ 已开启本群的大模型回复功能！现在可以正常聊天啦~"
@@ -22,6 +22,8 @@ class ModelProvider:
     model: str
     is_vision: bool = False
     is_search: bool = False
+    # 在 system 消息上标注 cache_control，供支持显式前缀缓存的 OpenAI 兼容网关使用
+    prompt_cache: bool = False
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> "ModelProvider":
@@ -36,7 +38,8 @@ class ModelProvider:
             api_keys=keys,
             model=data.get("model", ""),
             is_vision=data.get("is_vision_capable", False),
-            is_search=data.get("is_web_search_capable", False)
+            is_search=data.get("is_web_search_capable", False),
+            prompt_cache=data.get("prompt_cache", False)
         )
 
 def _load_providers() -> List[ModelProvider]:
@@ -66,6 +69,8 @@ class LLMConfig:
     
     max_tokens: int = 2048
     temperature: float = 0.8
+    # 对冲请求延迟 (秒)：当前候选超过该时间未返回时并行尝试下一个候选；0 表示关闭（失败后才切换候选）
+    hedge_delay: float = float(os.getenv("LLM_HEDGE_DELAY", "0"))
     
     # Backward compatibility properties (optional, mainly for type checkers or legacy access)
     @property
@@ -93,12 +98,16 @@ class WebSocketConfig:
     host: str = os.getenv("WS_HOST", "127.0.0.1")
     port: int = int(os.getenv("WS_PORT", "6199"))
     access_token: Optional[str] = os.getenv("WS_TOKEN")
+    # 图片以 file:// 本地路径发送（仅当 OneBot 实现与机器人共享文件系统时可用，默认关闭），否则读取文件并以 base64 发送
+    image_file_uri: bool = os.getenv("IMAGE_FILE_URI", "false").lower() in ("1", "true", "yes")
 
 
 @dataclass
 class DatabaseConfig:
     """数据库配置"""
     db_path: str = os.getenv("DB_PATH", "data/game.db")
+    # 连接时设置 WAL / 缓存 / mmap 等 PRAGMA；网络文件系统等不支持 WAL 的环境可关闭
+    pragma_tuning: bool = os.getenv("DB_PRAGMA_TUNING", "true").lower() in ("1", "true", "yes")
 
 
 @dataclass
@@ -129,11 +138,23 @@ class BotConfig:
     friend_request_auto_approve: bool = True
     private_chat_blacklist: Tuple[int, ...] = field(default_factory=tuple)
 
+@dataclass
+class SkillConfig:
+    """Skill Agent 后台任务配置"""
+    # 同时执行的后台任务数
+    max_concurrent_tasks: int = 4
+    # 运行中 + 排队中的后台任务上限，超出时直接拒绝
+    max_pending_tasks: int = 32
+    # ReAct 单步 LLM 调用超时 (秒)，超时后提示模型重新考虑而不是终止整个任务
+    step_timeout: float = 60.0
+
 @dataclass
 class VisionConfig:
     """视觉模型配置"""
     # 自动筛选具有视觉能力的模型
     candidates: List[ModelProvider] = field(default_factory=lambda: [p for p in ALL_PROVIDERS if p.is_vision])
+    # 同一候选同时在途的 key 数量：1 为逐个尝试；大于 1 时多个 key 并发竞速（更快但消耗更多额度）
+    key_concurrency: int = int(os.getenv("VISION_KEY_CONCURRENCY", "1"))
 
 @dataclass
 class SearchConfig:
@@ -154,6 +175,7 @@ class Config:
         self.bot_info = BotConfig()
         self.vision = VisionConfig()
         self.search = SearchConfig()
+        self.skill = SkillConfig()
 
 
 # 全局配置实例
@@ -6,6 +6,7 @@ import os
 import json
 from datetime import datetime
 from typing import Optional, List
+from ..config import config
 from .models import Relationship, UserProfile, ConversationMemory, GlobalUserMemory
 
 
@@ -15,6 +16,8 @@ class Database:
     def __init__(self, db_path: str = "data/game.db"):
         self.db_path = db_path
         self._connection: Optional[aiosqlite.Connection] = None
+        # 跨群组用户记忆的修改计数，供上层缓存判断是否过期
+        self.memory_version = 0
     
     async def connect(self):
         """连接数据库"""
@@ -22,10 +25,24 @@ class Database:
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         self._connection = await aiosqlite.connect(self.db_path)
         self._connection.row_factory = aiosqlite.Row
+        await self._apply_pragmas()
         await self._init_tables()
         # 初始化后清理黑名单重复项
         await self._clean_blacklist_duplicates()
     
+    async def _apply_pragmas(self):
+        """设置连接级 PRAGMA：WAL 让读写互不阻塞，NORMAL 在 WAL 下每次提交少一次 fsync，mmap 减少读取系统调用"""
+        if not config.database.pragma_tuning:
+            return
+        await self._connection.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA cache_size=-65536;
+            PRAGMA mmap_size=268435456;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA wal_autocheckpoint=1000;
+        """)
+    
     async def close(self):
         """关闭数据库连接"""
         if self._connection:
@@ -739,6 +756,7 @@ class Database:
              datetime.now(), memory.user_id)
         )
         await self._connection.commit()
+        self.memory_version += 1
     
     async def increment_global_user_interaction(self, user_id: int):
         """增加用户的全局互动计数"""
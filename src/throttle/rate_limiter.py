@@ -41,13 +41,16 @@ class TokenBucket:
         self.refill_rate = refill_rate
         self.tokens = capacity
         self.last_refill = time.time()
-        self._lock = asyncio.Lock()
+        # 每个群一个令牌桶，锁在首次 acquire 时再创建
+        self._lock: Optional[asyncio.Lock] = None
     
     async def acquire(self, tokens: int = 1) -> Tuple[bool, float]:
         """
         尝试获取令牌
         Returns: (是否成功, 需等待时间)
         """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
         async with self._lock:
             self._refill()
             
@@ -0,0 +1,115 @@
+"""
+基于 aiohttp 的 httpx 传输层
+供 OpenAI SDK 等基于 httpx 的客户端使用，在大量并发请求下比 httpx 自带连接池更稳定
+"""
+import asyncio
+from typing import Optional
+
+import httpx
+
+try:
+    import aiohttp
+except ImportError:  # 未安装 aiohttp 时退回 httpx 自带传输层
+    aiohttp = None
+
+# 由 aiohttp 自动解压后不再适用的响应头
+_DROP_RESPONSE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+def _map_error(e: Exception, request: httpx.Request) -> Exception:
+    """把 aiohttp 异常转换为对应的 httpx 异常"""
+    if isinstance(e, asyncio.TimeoutError):
+        return httpx.ReadTimeout(str(e) or "aiohttp request timed out", request=request)
+    if isinstance(e, aiohttp.ClientConnectionError):
+        return httpx.ConnectError(str(e), request=request)
+    return httpx.NetworkError(str(e), request=request)
+
+
+class _AioResponseStream(httpx.AsyncByteStream):
+    """按到达顺序逐块读取 aiohttp 响应体，关闭时释放连接"""
+
+    def __init__(self, resp: "aiohttp.ClientResponse", request: httpx.Request):
+        self._resp = resp
+        self._request = request
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._resp.content.iter_any():
+                yield chunk
+        except asyncio.TimeoutError as e:
+            raise httpx.ReadTimeout(str(e) or "aiohttp read timed out", request=self._request) from e
+        except aiohttp.ClientError as e:
+            raise httpx.ReadError(str(e), request=self._request) from e
+
+    async def aclose(self) -> None:
+        self._resp.release()
+
+
+class AioTransport(httpx.AsyncBaseTransport):
+    """把 httpx 请求转发给共享的 aiohttp.ClientSession"""
+
+    def __init__(self, limit: int = 256, keepalive_timeout: float = 60.0):
+        self._limit = limit
+        self._keepalive_timeout = keepalive_timeout
+        self._session: Optional["aiohttp.ClientSession"] = None
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        # 延迟创建：ClientSession 必须在运行中的事件循环里构造
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limit, keepalive_timeout=self._keepalive_timeout),
+                auto_decompress=True,
+            )
+        return self._session
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        session = self._get_session()
+        timeout = request.extensions.get("timeout", {})
+        body = await request.aread()
+
+        try:
+            resp = await session.request(
+                request.method,
+                str(request.url),
+                headers=list(request.headers.multi_items()),
+                data=body or None,
+                allow_redirects=False,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    connect=timeout.get("connect"),
+                    sock_read=timeout.get("read"),
+                ),
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            raise _map_error(e, request) from e
+
+        # 不预读响应体：由 httpx 按需迭代，流式接口可边到达边处理
+        headers = [
+            (k, v) for k, v in resp.headers.items()
+            if k.lower() not in _DROP_RESPONSE_HEADERS
+        ]
+        return httpx.Response(
+            status_code=resp.status,
+            headers=headers,
+            stream=_AioResponseStream(resp, request),
+            request=request,
+        )
+
+    async def aclose(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+def make_async_client(timeout: float = 60.0, max_connections: int = 256, keepalive_expiry: float = 60.0) -> httpx.AsyncClient:
+    """创建 httpx.AsyncClient，可用时使用 aiohttp 传输层"""
+    if aiohttp is not None:
+        return httpx.AsyncClient(
+            transport=AioTransport(limit=max_connections, keepalive_timeout=keepalive_expiry),
+            timeout=httpx.Timeout(timeout),
+        )
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=max_connections, keepalive_expiry=keepalive_expiry),
+        timeout=httpx.Timeout(timeout),
+        http2=True,
+    )
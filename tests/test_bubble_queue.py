@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+
+bot_module = pytest.importorskip("src.bot.bot")
+
+
+class FakeOneBot:
+    """记录发送顺序的 OneBot 客户端，可为指定目标设置发送耗时或失败"""
+
+    def __init__(self, slow=None, fail=()):
+        self.slow = slow or {}
+        self.fail = set(fail)
+        self.sent = []
+
+    async def send_group_msg(self, group_id, message):
+        await asyncio.sleep(self.slow.get(group_id, 0))
+        self.sent.append((group_id, message))
+
+    async def send_private_msg(self, user_id, message):
+        await asyncio.sleep(self.slow.get(user_id, 0))
+        if user_id in self.fail:
+            raise RuntimeError("ActionFailed: not a friend")
+        self.sent.append((user_id, message))
+
+
+_real_sleep = asyncio.sleep
+
+
+async def _fast_sleep(delay, *args):
+    # 气泡间隔缩短为 0，让测试不必真的等待 1.5 秒
+    await _real_sleep(0)
+
+
+def _make_bot(monkeypatch, onebot):
+    monkeypatch.setattr(bot_module, "_OUT_WORKER_IDLE", 0.05)
+    bot = bot_module.DaiyoseiBot.__new__(bot_module.DaiyoseiBot)
+    bot._bot = onebot
+    bot._bubble_queues = {}
+    bot._bubble_workers = {}
+    bot._send_pending = {}
+    bot._send_tail = {}
+
+    async def build_bubbles(target_id, response, is_group):
+        return [("msg", seg["text"]) for seg in response.multi_segments]
+
+    bot._build_bubbles = build_bubbles
+    return bot
+
+
+async def _drain(bot):
+    while bot._bubble_workers:
+        await asyncio.sleep(0.01)
+
+
+async def test_slow_conversation_does_not_delay_others(monkeypatch):
+    onebot = FakeOneBot(slow={1: 0.3})
+    bot = _make_bot(monkeypatch, onebot)
+    now = time.monotonic()
+    bot._enqueue_bubble(now, 1, True, 2, ("msg", "slow"))
+    bot._enqueue_bubble(now, 2, True, 2, ("msg", "fast"))
+
+    await asyncio.sleep(0.1)
+    assert onebot.sent == [(2, "fast")]
+
+    await _drain(bot)
+    assert onebot.sent == [(2, "fast"), (1, "slow")]
+    assert bot._send_pending == {} and bot._send_tail == {}
+
+
+async def test_bubbles_of_one_conversation_keep_their_order(monkeypatch):
+    onebot = FakeOneBot()
+    bot = _make_bot(monkeypatch, onebot)
+    now = time.monotonic()
+    for index, text in enumerate(("a", "b", "c"), start=2):
+        bot._enqueue_bubble(now + index * 0.01, 1, True, index, ("msg", text))
+
+    await _drain(bot)
+
+    assert [message for _, message in onebot.sent] == ["a", "b", "c"]
+    assert not bot._bubble_queues
+
+
+async def test_response_queues_behind_pending_bubbles(monkeypatch):
+    onebot = FakeOneBot()
+    bot = _make_bot(monkeypatch, onebot)
+    bot._enqueue_bubble(time.monotonic() + 0.1, 1, True, 2, ("msg", "queued"))
+
+    response = bot_module.GameResponse(text="next")
+    await bot._dispatch_response(1, response, True)
+
+    # 首条气泡没有插队到仍在排队的气泡之前
+    assert onebot.sent == []
+    assert bot._send_pending[(True, 1)] == 2
+
+
+async def test_wait_sends_every_bubble_after_the_backlog(monkeypatch):
+    monkeypatch.setattr(bot_module.asyncio, "sleep", _fast_sleep)
+    onebot = FakeOneBot()
+    bot = _make_bot(monkeypatch, onebot)
+    bot._enqueue_bubble(time.monotonic(), 5, False, 2, ("msg", "queued"))
+
+    response = bot_module.GameResponse(text="a")
+    response.add_segment(text="b")
+    await bot._dispatch_response(5, response, False, wait=True)
+
+    assert [message for _, message in onebot.sent] == ["queued", "a", "b"]
+
+
+async def test_wait_raises_private_failure_despite_backlog(monkeypatch):
+    onebot = FakeOneBot(fail={9})
+    bot = _make_bot(monkeypatch, onebot)
+    bot._enqueue_bubble(time.monotonic(), 9, False, 2, ("msg", "queued"))
+
+    with pytest.raises(RuntimeError, match="not a friend"):
+        await bot._dispatch_response(9, bot_module.GameResponse(text="hi"), False, wait=True)
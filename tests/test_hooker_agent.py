@@ -0,0 +1,179 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+hooker_module = pytest.importorskip("src.ai.agents.hooker_agent")
+Hook = hooker_module.Hook
+HookerAgent = hooker_module.HookerAgent
+
+
+@pytest.fixture
+def hooks_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(HookerAgent, "HOOKS_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def agent(hooks_dir):
+    return HookerAgent()
+
+
+def _add(agent, hook_id, group_id, trigger_type="time", trigger_value="", triggered=False):
+    now = time.time()
+    hook = Hook(
+        hook_id=hook_id, group_id=group_id, trigger_type=trigger_type, trigger_value=trigger_value,
+        content_hint="hint", reason="reason", created_at=now,
+        trigger_ts=now + 3600 if trigger_type == "time" else 0.0,
+    )
+    agent.hooks[hook_id] = hook
+    agent._index_hook(hook)
+    if triggered:
+        hook.triggered = True
+        agent._unindex_hook(hook)
+    return hook
+
+
+def test_cancel_removes_hook_from_every_index(agent):
+    _add(agent, "aaaa1111", 1, trigger_type="keyword", trigger_value="早安")
+    _add(agent, "bbbb2222", 1)
+
+    ok, _ = agent.cancel_hook("aaaa1111", group_id=1)
+    assert ok
+    ok, _ = agent.cancel_hook("bbbb", group_id=1)
+    assert ok
+
+    assert not agent.hooks
+    assert not agent.group_hooks.get(1)
+    assert 1 not in agent._pending_kw
+    assert agent.get_group_pending_hooks(1) == []
+
+
+def test_cancel_with_group_finds_triggered_hook(agent):
+    _add(agent, "cccc3333", 1, triggered=True)
+
+    ok, _ = agent.cancel_hook("cccc", group_id=1)
+
+    assert ok
+    assert "cccc3333" not in agent.hooks
+
+
+def test_cancel_rejects_hook_of_other_group(agent):
+    _add(agent, "dddd4444", 2)
+
+    ok, message = agent.cancel_hook("dddd4444", group_id=1)
+
+    assert not ok
+    assert "不属于当前群组" in message
+    assert "dddd4444" in agent.hooks
+
+
+def test_cancel_prefix_ambiguity_is_scoped_to_group(agent):
+    _add(agent, "eeee0001", 1)
+    _add(agent, "eeee0002", 2)
+
+    ok, _ = agent.cancel_hook("eeee", group_id=1)
+    assert ok
+    assert set(agent.hooks) == {"eeee0002"}
+
+    _add(agent, "ffff0001", 1)
+    _add(agent, "ffff0002", 1)
+    ok, message = agent.cancel_hook("ffff", group_id=1)
+    assert not ok
+    assert "多个 Hook" in message
+
+
+async def test_cancelled_time_hook_heap_entry_is_dropped_lazily(agent, monkeypatch):
+    hook = _add(agent, "gggg0001", 1)
+    hook.trigger_ts = time.time() - 1
+    agent._schedule(hook)
+    triggered = []
+
+    async def record(hooks):
+        triggered.extend(hooks)
+
+    monkeypatch.setattr(agent, "_trigger_hooks", record)
+    ok, _ = agent.cancel_hook("gggg0001", group_id=1)
+    await agent.check_and_trigger_time_hooks()
+
+    assert ok
+    assert triggered == []
+    assert all(entry[1] != "gggg0001" or entry[0] > time.time() for entry in agent._time_heap)
+
+
+def _hook_dict(hook_id, group_id=1, trigger_type="keyword", trigger_value="早安", **extra):
+    data = {
+        "hook_id": hook_id, "group_id": group_id, "trigger_type": trigger_type,
+        "trigger_value": trigger_value, "content_hint": "hint", "reason": "reason",
+        "created_at": time.time(), "triggered": False, "trigger_time": None,
+    }
+    data.update(extra)
+    return data
+
+
+def _write_log(hooks_dir, ops, tail=""):
+    lines = "".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops)
+    (hooks_dir / HookerAgent.HOOKS_LOG).write_text(lines + tail, encoding="utf-8")
+
+
+def _snapshot_ids(hooks_dir):
+    data = json.loads((hooks_dir / HookerAgent.HOOKS_FILE).read_text(encoding="utf-8"))
+    return {hook["hook_id"] for hook in data["hooks"]}
+
+
+def test_load_replays_put_trigger_and_del(hooks_dir):
+    snapshot = {"hooks": [_hook_dict("a"), _hook_dict("b")]}
+    (hooks_dir / HookerAgent.HOOKS_FILE).write_text(json.dumps(snapshot), encoding="utf-8")
+    _write_log(hooks_dir, [
+        {"op": "put", "hook": _hook_dict("c", trigger_value="晚安")},
+        {"op": "trigger", "id": "b", "t": time.time()},
+        {"op": "del", "id": "a"},
+    ])
+
+    agent = HookerAgent()
+
+    assert set(agent.hooks) == {"c"}
+    assert agent._pending_kw[1] == {"晚安": ["c"]}
+    # 启动时日志合并进快照
+    assert (hooks_dir / HookerAgent.HOOKS_LOG).read_bytes() == b""
+    assert _snapshot_ids(hooks_dir) == {"c"}
+
+
+def test_load_skips_truncated_last_line(hooks_dir):
+    _write_log(hooks_dir, [{"op": "put", "hook": _hook_dict("a")}], tail='{"op": "put", "hook": {"hook_id')
+
+    agent = HookerAgent()
+
+    assert set(agent.hooks) == {"a"}
+
+
+def test_log_is_compacted_every_compact_every_ops(agent, hooks_dir, monkeypatch):
+    monkeypatch.setattr(HookerAgent, "COMPACT_EVERY", 3)
+    log_file = hooks_dir / HookerAgent.HOOKS_LOG
+
+    for hook_id in ("a", "b"):
+        agent._append_hook(_add(agent, hook_id, 1))
+        agent._flush_dirty()
+    assert len(log_file.read_text(encoding="utf-8").splitlines()) == 2
+
+    agent._append_hook(_add(agent, "c", 1))
+    agent._flush_dirty()
+
+    assert log_file.read_bytes() == b""
+    assert _snapshot_ids(hooks_dir) == {"a", "b", "c"}
+    assert set(HookerAgent().hooks) == {"a", "b", "c"}
+
+
+def test_load_baseline_snapshot_without_trigger_ts(hooks_dir):
+    when = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
+    hook = _hook_dict("a", trigger_type="time", trigger_value=when.isoformat())
+    (hooks_dir / HookerAgent.HOOKS_FILE).write_text(
+        json.dumps({"hooks": [hook], "last_updated": datetime.now().isoformat()}, ensure_ascii=False, indent=2),
+        encoding="utf-8",
+    )
+
+    agent = HookerAgent()
+
+    assert agent.hooks["a"].trigger_ts == when.timestamp()
+    assert (when.timestamp(), "a") in agent._time_heap
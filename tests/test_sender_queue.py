@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+bot_module = pytest.importorskip("src.bot.bot")
+from src.bot.handler import GameResponse
+
+
+def _make_bot(monkeypatch, fail_targets=()):
+    """只带出站队列状态的 DaiyoseiBot，_dispatch_response 记录每次实际分发的响应"""
+    monkeypatch.setattr(bot_module, "_OUT_WORKER_IDLE", 0.05)
+    bot = bot_module.DaiyoseiBot.__new__(bot_module.DaiyoseiBot)
+    bot._out_queues = {}
+    bot._out_workers = {}
+    bot._last_self_sig = {}
+    bot.sent = []
+
+    async def dispatch(target_id, response, is_group, raise_private=True, wait=False):
+        if target_id in fail_targets:
+            raise RuntimeError("ActionFailed: not a friend")
+        response.waited = wait
+        bot.sent.append(response)
+
+    bot._dispatch_response = dispatch
+    return bot
+
+
+async def _drain(bot):
+    while bot._out_workers:
+        await asyncio.sleep(0.01)
+
+
+def _texts(response):
+    return [seg.get("text") for seg in response.multi_segments]
+
+
+def test_merge_responses_joins_first_bubble_when_staggered():
+    first = GameResponse(text="a")
+    nxt = GameResponse(text="b")
+    nxt.add_segment(text="c")
+
+    merged = bot_module._merge_responses(first, nxt)
+
+    assert _texts(merged) == ["a", "b", "c"]
+    assert [seg.get("bubble_join", False) for seg in merged.multi_segments] == [False, True, False]
+    assert "bubble_join" not in nxt.multi_segments[0]
+
+
+def test_merge_responses_joins_every_bubble_when_not_staggered():
+    first = GameResponse(text="a", reply_to=7)
+    nxt = GameResponse(text="b")
+    nxt.add_segment(text="c")
+    nxt.staggered = False
+
+    merged = bot_module._merge_responses(first, nxt)
+
+    assert merged.reply_to == 7
+    assert [seg.get("bubble_join", False) for seg in merged.multi_segments] == [False, True, True]
+
+
+async def test_backlog_is_merged_into_one_dispatch(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    for text in ("a", "b", "c"):
+        await bot._on_handler_proactive_message(1, GameResponse(text=text), True)
+    await _drain(bot)
+
+    assert len(bot.sent) == 1
+    assert _texts(bot.sent[0]) == ["a", "b", "c"]
+    assert not bot._out_queues
+
+
+async def test_reply_to_starts_a_new_dispatch(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    await bot._on_handler_proactive_message(1, GameResponse(text="a"), True)
+    await bot._on_handler_proactive_message(1, GameResponse(text="b", reply_to=42), True)
+    await bot._on_handler_proactive_message(1, GameResponse(text="c"), True)
+    await _drain(bot)
+
+    assert [_texts(r) for r in bot.sent] == [["a"], ["b", "c"]]
+    assert bot.sent[1].reply_to == 42
+
+
+async def test_custom_action_is_not_merged(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    action = GameResponse()
+    action.add_segment(custom_action={"action": "poke"})
+    await bot._on_handler_proactive_message(1, GameResponse(text="a"), True)
+    await bot._on_handler_proactive_message(1, action, True)
+    await _drain(bot)
+
+    assert len(bot.sent) == 2
+    assert bot.sent[1] is action
+
+
+async def test_merge_stops_at_size_limit(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    monkeypatch.setattr(bot_module, "_MERGE_MAX_CHARS", 5)
+    for text in ("abc", "def", "g"):
+        await bot._on_handler_proactive_message(1, GameResponse(text=text), True)
+    await _drain(bot)
+
+    assert [_texts(r) for r in bot.sent] == [["abc"], ["def", "g"]]
+
+
+async def test_self_signature_only_for_responses_in_context(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    await bot._on_handler_proactive_message(1, GameResponse(text="hook message"), True)
+    assert 1 not in bot._last_self_sig
+
+    response = GameResponse(text="reply")
+    response.in_context = True
+    await bot._on_handler_proactive_message(1, response, True)
+    assert bot._last_self_sig[1] == hash("reply")
+    await _drain(bot)
+
+
+async def test_conversations_have_separate_queues(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    await bot._on_handler_proactive_message(1, GameResponse(text="a"), True)
+    await bot._on_handler_proactive_message(1, GameResponse(text="b"), False)
+    assert set(bot._out_workers) == {(True, 1), (False, 1)}
+    await _drain(bot)
+
+    assert sorted(_texts(r)[0] for r in bot.sent) == ["a", "b"]
+
+
+async def test_wait_returns_after_the_send(monkeypatch):
+    bot = _make_bot(monkeypatch)
+    await bot._on_handler_proactive_message(5, GameResponse(text="a"), False)
+    await bot._on_handler_proactive_message(5, GameResponse(text="b"), False, wait=True)
+
+    # 需要结果的响应不与前面积压的响应合并，且整条在消费任务内发完
+    assert [_texts(r) for r in bot.sent] == [["a"], ["b"]]
+    assert [r.waited for r in bot.sent] == [False, True]
+    await _drain(bot)
+
+
+async def test_wait_raises_send_failure(monkeypatch):
+    bot = _make_bot(monkeypatch, fail_targets={9})
+    with pytest.raises(RuntimeError, match="not a friend"):
+        await bot._on_handler_proactive_message(9, GameResponse(text="hi"), False, wait=True)
+
+    # 不等待结果时，发送失败只记录日志
+    await bot._on_handler_proactive_message(9, GameResponse(text="hi"), False)
+    await _drain(bot)
+    assert bot.sent == []
@@ -4,9 +4,15 @@ import json
 import sys
 import os
 
+import pytest
+
 # Ensure src is in path
 sys.path.append(os.getcwd())
 
+# 缺少运行依赖（openai、httpx 等）时跳过
+pytest.importorskip("openai")
+pytest.importorskip("src.bot.command_system")
+
 # Mocking external dependencies
 mock_db = MagicMock()
 # Ensure get_all_speakers_memory returns an empty dict for now, but is awaitable
@@ -20,6 +26,10 @@ mock_message.content = "你好呀！我是琪露诺~"
 mock_message.tool_calls = None
 mock_choice.message = mock_message
 mock_llm_response.choices = [mock_choice]
+# LLMService 通过 with_raw_response 读取原始 JSON
+mock_llm_response.content = json.dumps({
+    "choices": [{"message": {"role": "assistant", "content": mock_message.content, "tool_calls": None}}]
+}).encode("utf-8")
 
 async def test_bot_response_flow():
     print("Testing Bot Response Flow...")
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+skill_module = pytest.importorskip("src.ai.skill_agent")
+SkillAgent = skill_module.SkillAgent
+
+
+@pytest.fixture
+def agent():
+    return SkillAgent(tool_handlers={})
+
+
+def test_bracket_inside_string_argument(agent):
+    text = '[search_web: {"query": "a]b [c]"}]'
+    assert agent._parse_tool_calls(text) == [("search_web", '{"query": "a]b [c]"}')]
+
+
+def test_nested_objects_and_escaped_quotes(agent):
+    args = '{"a": {"b": {"c": 1}}, "s": "say \\"}\\" ok"}'
+    assert agent._parse_tool_calls(f"思考一下\n[create_hook: {args}]\n") == [("create_hook", args)]
+
+
+def test_several_calls_in_one_reply(agent):
+    text = '先搜索 [search_web: {"query": "x"}] 再看图 [look_at_image:\n{"image_url": "http://a/b.png"}\n]'
+    assert agent._parse_tool_calls(text) == [
+        ("search_web", '{"query": "x"}'),
+        ("look_at_image", '{"image_url": "http://a/b.png"}'),
+    ]
+
+
+def test_unterminated_argument_is_skipped(agent):
+    text = '[search_web: {"query": "x"] 然后 [list_hooks: {}]'
+    assert agent._parse_tool_calls(text) == [("list_hooks", "{}")]
+
+
+def test_call_without_closing_bracket_is_ignored(agent):
+    assert agent._parse_tool_calls('[search_web: {"query": "x"} 后面没有右括号') == []
+
+
+def _scanner():
+    return skill_module._StreamStopScanner(SkillAgent._STREAM_STOP_RE)
+
+
+def _stops_at(pieces):
+    """返回触发终止的分片下标，未触发返回 None"""
+    scanner = _scanner()
+    for i, piece in enumerate(pieces):
+        if scanner.feed(piece):
+            return i
+    return None
+
+
+def test_finish_marker_split_across_chunks():
+    assert _stops_at(["结果是 [FIN", "ISH: 完成", "了", "]", "多余"]) == 3
+
+
+def test_tool_result_marker_split_across_chunks():
+    assert _stops_at(["[search_web: {}]\n[To", "ol Res", "ult: 编造的内容"]) == 2
+
+
+def test_markers_inside_think_blocks_are_ignored():
+    assert _stops_at(["<thi", "nk>[FINISH: 草稿]</th", "ink>继续"]) is None
+    assert _stops_at(["<details open>[Tool Result", "]</details>", "[FINISH: ok]"]) == 2
+    # 未闭合的思考块里的标签也不算
+    assert _stops_at(["<think>[FINISH: 草稿]", "还在想"]) is None
+
+
+def test_unclosed_finish_keeps_waiting():
+    assert _stops_at(["[FINISH: " + "很长的结果" * 50, "，还没结束"]) is None
+
+
+async def test_stream_response_truncates_fake_tool_result():
+    closed = []
+
+    async def stream(messages, group_id=0):
+        try:
+            for piece in ("<think>想想</think>", '[search_web: {"q": 1}]\n', "[Tool Re", "sult: 假的]", "不应读到"):
+                yield piece
+        finally:
+            closed.append(True)
+
+    agent = SkillAgent(tool_handlers={}, stream_llm_handler=stream)
+
+    assert await agent._stream_response([]) == '[search_web: {"q": 1}]'
+    assert closed == [True]
+
+
+async def test_side_effect_tools_are_barriers():
+    events = []
+
+    def tool(name, delay):
+        async def handler(**kwargs):
+            events.append(("start", name))
+            await asyncio.sleep(delay)
+            events.append(("end", name))
+            return name
+        return handler
+
+    agent = SkillAgent(tool_handlers={
+        "list_hooks": tool("list_hooks", 0.02),
+        "recall_user_memory": tool("recall_user_memory", 0.01),
+        "create_time_hook": tool("create_time_hook", 0.01),
+    })
+    calls = [("list_hooks", "{}"), ("recall_user_memory", "{}"), ("create_time_hook", "{}"), ("list_hooks", "{}")]
+
+    results = await agent._execute_tools(calls)
+
+    assert results == ["list_hooks", "recall_user_memory", "create_time_hook", "list_hooks"]
+    # 写操作之前的两个只读工具并发执行
+    assert events[:2] == [("start", "list_hooks"), ("start", "recall_user_memory")]
+    # 写操作在前面的只读工具都结束后才开始，之后的只读工具在它结束后才开始
+    write_start = events.index(("start", "create_time_hook"))
+    assert ("end", "list_hooks") in events[:write_start]
+    assert events[write_start + 1:] == [("end", "create_time_hook"), ("start", "list_hooks"), ("end", "list_hooks")]